@@ -9,7 +9,7 @@ import sqlmodel.sql.sqltypes
 
 from sqlmodel import SQLModel
 
-from sandbox.db3 import engine
+from database import engine
 
 
 # this is the Alembic Config object, which provides
@@ -54,9 +54,8 @@ def run_migrations_offline() -> None:
     script output.
 
     """
-    url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=str(engine.url),
+        url=engine.url.render_as_string(hide_password=False),
         target_metadata=target_metadata,
         literal_binds=True,
         compare_type=True,
@@ -0,0 +1,32 @@
+"""Add chatmember.next_notify_time
+
+Revision ID: 431ba1546549
+Revises: 4ccf507a8bb2
+Create Date: 2026-10-18 09:12:40.118204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '431ba1546549'
+down_revision: Union[str, Sequence[str], None] = '4ccf507a8bb2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chatmember', sa.Column('next_notify_time', sa.Float(), nullable=True))
+    op.create_index(op.f('ix_chatmember_next_notify_time'), 'chatmember', ['next_notify_time'], unique=False)
+    # Existing rows are filled in by db_handlers.refresh_all_next_notify_times()
+    # when the bot starts.
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_chatmember_next_notify_time'), table_name='chatmember')
+    op.drop_column('chatmember', 'next_notify_time')
@@ -0,0 +1,30 @@
+"""Add (chat_id, user_id) indexes for paging admins and members
+
+Revision ID: 5e0c8b7d2f41
+Revises: a97aaa1a1a09
+Create Date: 2026-10-18 16:31:52.207334
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e0c8b7d2f41'
+down_revision: Union[str, Sequence[str], None] = 'a97aaa1a1a09'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_chatadmin_chat_user', 'chatadmin', ['chat_id', 'user_id'], unique=False)
+    op.create_index('ix_chatmember_chat_user', 'chatmember', ['chat_id', 'user_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chatmember_chat_user', table_name='chatmember')
+    op.drop_index('ix_chatadmin_chat_user', table_name='chatadmin')
@@ -0,0 +1,41 @@
+"""Add worker and shardlease tables for chat sharding
+
+Revision ID: a97aaa1a1a09
+Revises: af6de3326d48
+Create Date: 2026-10-18 14:05:21.402117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a97aaa1a1a09'
+down_revision: Union[str, Sequence[str], None] = 'af6de3326d48'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('worker',
+    sa.Column('id', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('address', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('expires_at', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('shardlease',
+    sa.Column('shard', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('worker_id', sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+    sa.Column('expires_at', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('shard')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('shardlease')
+    op.drop_table('worker')
@@ -0,0 +1,28 @@
+"""Add composite index for the notification query
+
+Revision ID: af6de3326d48
+Revises: 431ba1546549
+Create Date: 2026-10-18 11:47:03.530611
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'af6de3326d48'
+down_revision: Union[str, Sequence[str], None] = '431ba1546549'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_chatmember_notify', 'chatmember', ['chat_id', 'is_muted', 'last_trigger_time', 'last_notify_time'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chatmember_notify', table_name='chatmember')
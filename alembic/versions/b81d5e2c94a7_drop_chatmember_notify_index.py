@@ -0,0 +1,28 @@
+"""Drop the unused chatmember notify index
+
+Revision ID: b81d5e2c94a7
+Revises: f24c409a7558
+Create Date: 2026-10-18 21:04:12.318227
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b81d5e2c94a7'
+down_revision: Union[str, Sequence[str], None] = 'f24c409a7558'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.drop_index('ix_chatmember_notify', table_name='chatmember')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_index('ix_chatmember_notify', 'chatmember', ['chat_id', 'is_muted', 'last_trigger_time', 'last_notify_time'], unique=False)
@@ -0,0 +1,55 @@
+"""Replace the chat trigger flags with a bitmask
+
+Revision ID: c3e1f09b7a52
+Revises: 5e0c8b7d2f41
+Create Date: 2026-10-18 18:02:41.518306
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3e1f09b7a52'
+down_revision: Union[str, Sequence[str], None] = '5e0c8b7d2f41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Flag column -> database.Trigger bit, as of this revision.
+TRIGGER_BITS = {
+    'text_triggers': 1,
+    'photo_triggers': 2,
+    'video_triggers': 4,
+    'voice_triggers': 8,
+    'video_note_triggers': 16,
+    'join_triggers': 32,
+}
+
+chat = sa.table(
+    'chat',
+    sa.column('triggers', sa.Integer()),
+    *(sa.column(name, sa.Boolean()) for name in TRIGGER_BITS),
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chat', sa.Column('triggers', sa.Integer(), nullable=False, server_default='0'))
+    op.execute(chat.update().values(triggers=sum(
+        (sa.case((chat.c[name], bit), else_=0) for name, bit in TRIGGER_BITS.items()),
+        sa.literal(0),
+    )))
+    for name in TRIGGER_BITS:
+        op.drop_column('chat', name)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for name in TRIGGER_BITS:
+        op.add_column('chat', sa.Column(name, sa.Boolean(), nullable=False, server_default=sa.false()))
+    op.execute(chat.update().values({
+        name: chat.c.triggers.op('&')(bit) != 0 for name, bit in TRIGGER_BITS.items()
+    }))
+    op.drop_column('chat', 'triggers')
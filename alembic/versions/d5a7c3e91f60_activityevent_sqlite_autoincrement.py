@@ -0,0 +1,43 @@
+"""Never reuse activityevent ids on SQLite
+
+Revision ID: d5a7c3e91f60
+Revises: b81d5e2c94a7
+Create Date: 2026-10-18 22:37:51.604113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5a7c3e91f60'
+down_revision: Union[str, Sequence[str], None] = 'b81d5e2c94a7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Other databases take ids from a sequence, which never goes back.
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table('activityevent', recreate='always', table_kwargs={'sqlite_autoincrement': True}) as batch_op:
+        pass
+    # Continue above the activity watermarks too, in case the log was
+    # trimmed empty and its ids already started over.
+    op.execute("DELETE FROM sqlite_sequence WHERE name = 'activityevent'")
+    op.execute(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'activityevent', max("
+        "(SELECT coalesce(max(id), 0) FROM activityevent), "
+        "(SELECT coalesce(max(value), 0) FROM checkpoint WHERE name LIKE 'activity:%'))"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    with op.batch_alter_table('activityevent', recreate='always', table_kwargs={'sqlite_autoincrement': False}) as batch_op:
+        pass
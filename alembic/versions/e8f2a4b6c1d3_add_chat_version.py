@@ -0,0 +1,32 @@
+"""Add chat version, replacing the global state version
+
+Revision ID: e8f2a4b6c1d3
+Revises: d5a7c3e91f60
+Create Date: 2026-10-18 23:12:40.275318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e8f2a4b6c1d3'
+down_revision: Union[str, Sequence[str], None] = 'd5a7c3e91f60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+checkpoint = sa.table('checkpoint', sa.column('name', sa.String()))
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chat', sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+    op.execute(checkpoint.delete().where(checkpoint.c.name == 'state_version'))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # Older db_handlers.db_init creates the state_version checkpoint again.
+    op.drop_column('chat', 'version')
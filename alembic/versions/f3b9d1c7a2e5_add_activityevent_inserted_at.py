@@ -0,0 +1,36 @@
+"""Add activityevent inserted_at
+
+Revision ID: f3b9d1c7a2e5
+Revises: e8f2a4b6c1d3
+Create Date: 2026-10-19 00:41:08.517264
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3b9d1c7a2e5'
+down_revision: Union[str, Sequence[str], None] = 'e8f2a4b6c1d3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+activityevent = sa.table(
+    'activityevent',
+    sa.column('ts', sa.Float()),
+    sa.column('inserted_at', sa.Float()),
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('activityevent', sa.Column('inserted_at', sa.Float(), nullable=False, server_default='0'))
+    # The best guess for events logged so far.
+    op.execute(activityevent.update().values(inserted_at=activityevent.c.ts))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('activityevent', 'inserted_at')
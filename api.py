@@ -0,0 +1,163 @@
+import hashlib
+import hmac
+import json
+from typing import Any, NamedTuple
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from pydantic import BaseModel, Field
+
+import async_handlers as adbh
+import config
+import read_model
+from database import Trigger
+from db_handlers import SaveResult
+from read_model import ChatRow, ChatView, LinkRow
+
+
+def check_token(authorization: str = Header("")) -> None:
+    # Closed unless a token is configured.
+    if not config.API_TOKEN or not hmac.compare_digest(
+        authorization, f"Bearer {config.API_TOKEN}"
+    ):
+        raise HTTPException(401)
+
+
+router = APIRouter(prefix="/api", dependencies=[Depends(check_token)])
+
+PageSize = Query(100, ge=1, le=config.API_MAX_PAGE_SIZE)
+
+
+def _fields(row_type: type[NamedTuple], fields: str | None) -> tuple[str, ...]:
+    # Comma separated subset of the row's fields; all of them by default.
+    if not fields:
+        return row_type._fields
+    selected = tuple(field.strip() for field in fields.split(","))
+    unknown = set(selected) - set(row_type._fields)
+    if unknown:
+        raise HTTPException(400, f"Unknown fields: {', '.join(sorted(unknown))}")
+    return selected
+
+
+def _shape(row: NamedTuple, fields: tuple[str, ...]) -> dict[str, Any]:
+    return {field: getattr(row, field) for field in fields}
+
+
+def _etag_response(request: Request, payload: Any) -> Response:
+    # The ETag is a hash of the body, so it also changes when another
+    # process (the panel, the bot) wrote the data.
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+    etag = f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in (
+        tag.strip() for tag in if_none_match.split(",")
+    ):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def _page(
+    request: Request, rows: list[LinkRow], limit: int, fields: str | None
+) -> Response:
+    selected = _fields(LinkRow, fields)
+    return _etag_response(
+        request,
+        {
+            "items": [_shape(row, selected) for row in rows],
+            # Pass as `after` to get the next page.
+            "next_after": rows[-1].user_id if len(rows) == limit else None,
+        },
+    )
+
+
+@router.get("/admins/{admin_id}/chats")
+def admin_chats(request: Request, admin_id: int, fields: str | None = None) -> Response:
+    selected = _fields(ChatRow, fields)
+    rows = read_model.chats_by_admin(admin_id)
+    return _etag_response(request, [_shape(row, selected) for row in rows])
+
+
+@router.get("/chats/{chat_id}")
+def chat(request: Request, chat_id: int, fields: str | None = None) -> Response:
+    selected = _fields(ChatView, fields)
+    view = read_model.chat(chat_id)
+    if view is None:
+        raise HTTPException(404)
+    return _etag_response(request, _shape(view, selected))
+
+
+class ChatSettingsUpdate(BaseModel):
+    # Trigger bits, see database.Trigger.
+    triggers: int | None = Field(None, ge=0, le=~Trigger(0))
+    notify_time: float | None = Field(None, ge=0)
+    notify_max_time: float | None = Field(None, ge=0)
+    notify_interval: float | None = Field(None, ge=0)
+
+
+@router.patch("/chats/{chat_id}")
+async def update_chat(chat_id: int, update: ChatSettingsUpdate) -> dict[str, Any]:
+    # Merge into the current settings, not into a possibly stale cached copy.
+    read_model.invalidate(chat_id)
+    view = await adbh.run(read_model.chat, chat_id)
+    if view is None:
+        raise HTTPException(404)
+    view = view._replace(**update.model_dump(exclude_none=True))
+    if not await adbh.save_chat_settings(view):
+        raise HTTPException(500, "Failed to update settings")
+    # The chat may have been deleted between the save and this read.
+    view = await adbh.run(read_model.chat, chat_id)
+    if view is None:
+        raise HTTPException(404)
+    return view._asdict()
+
+
+@router.get("/chats/{chat_id}/admins")
+def chat_admins(
+    request: Request,
+    chat_id: int,
+    after: int | None = None,
+    limit: int = PageSize,
+    fields: str | None = None,
+) -> Response:
+    rows = read_model.chat_admins_page(chat_id, after, limit)
+    return _page(request, rows, limit, fields)
+
+
+@router.get("/chats/{chat_id}/members")
+def chat_members(
+    request: Request,
+    chat_id: int,
+    after: int | None = None,
+    limit: int = PageSize,
+    fields: str | None = None,
+) -> Response:
+    rows = read_model.chat_members_page(chat_id, after, limit)
+    return _page(request, rows, limit, fields)
+
+
+class MuteUpdate(BaseModel):
+    user_id: int
+    is_muted: bool
+
+
+def _save_result(result: SaveResult) -> dict[str, Any]:
+    return {
+        "updated": result.updated,
+        "errors": [
+            {"user_id": user_id, "reason": reason} for user_id, reason in result.errors
+        ],
+    }
+
+
+@router.patch("/chats/{chat_id}/admins")
+async def update_chat_admins(chat_id: int, updates: list[MuteUpdate]) -> dict[str, Any]:
+    rows = [{"Admin ID": u.user_id, "Is Muted": u.is_muted} for u in updates]
+    return _save_result(await adbh.save_admin_settings(rows, chat_id))
+
+
+@router.patch("/chats/{chat_id}/members")
+async def update_chat_members(
+    chat_id: int, updates: list[MuteUpdate]
+) -> dict[str, Any]:
+    rows = [{"Member ID": u.user_id, "Is Muted": u.is_muted} for u in updates]
+    return _save_result(await adbh.save_member_settings(rows, chat_id))
@@ -0,0 +1,69 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from time import perf_counter
+from typing import Awaitable, Callable, ParamSpec, TypeVar
+
+import db_handlers as dbh
+from metrics import DB_SECONDS, QUEUE_DEPTH
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+# SQLite has a single writer anyway, so all database I/O of the bot goes
+# through one dedicated thread. The event loop only awaits the result.
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+QUEUE_DEPTH.labels("db_executor").set_function(lambda: executor._work_queue.qsize())
+QUEUE_DEPTH.labels("trigger_buffer").set_function(lambda: len(dbh.trigger_buffer))
+
+
+async def run(func: Callable[P, R], *args: P.args, **kwargs: P.kwargs) -> R:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+
+def _awaitable(func: Callable[P, R]) -> Callable[P, Awaitable[R]]:
+    latency = DB_SECONDS.labels(func.__name__)
+
+    @wraps(func)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+        start = perf_counter()
+        try:
+            return await run(func, *args, **kwargs)
+        finally:
+            latency.observe(perf_counter() - start)
+
+    return wrapper
+
+
+db_init = _awaitable(dbh.db_init)
+bot_added_to_chat = _awaitable(dbh.bot_added_to_chat)
+bot_deleted_from_chat = _awaitable(dbh.bot_deleted_from_chat)
+chat_setup_complete = _awaitable(dbh.chat_setup_complete)
+add_chat_admins = _awaitable(dbh.add_chat_admins)
+user_left_chat = _awaitable(dbh.user_left_chat)
+user_joined_chat = _awaitable(dbh.user_joined_chat)
+promote_user_to_admin = _awaitable(dbh.promote_user_to_admin)
+demote_user_to_member = _awaitable(dbh.demote_user_to_member)
+got_message = _awaitable(dbh.got_message)
+get_sleepy_members = _awaitable(dbh.get_sleepy_members)
+set_last_notify_time = _awaitable(dbh.set_last_notify_time)
+flush_triggers = _awaitable(dbh.trigger_buffer.flush)
+compact_activity = _awaitable(dbh.compact_activity)
+refresh_all_next_notify_times = _awaitable(dbh.refresh_all_next_notify_times)
+get_next_notify_time = _awaitable(dbh.get_next_notify_time)
+save_chat_settings = _awaitable(dbh.save_chat_settings)
+save_admin_settings = _awaitable(dbh.save_admin_settings)
+save_member_settings = _awaitable(dbh.save_member_settings)
+
+next_notify_listeners = dbh.next_notify_listeners
+
+
+async def run_trigger_flush() -> None:
+    await dbh.trigger_buffer.run(executor)
+
+
+async def shutdown() -> None:
+    await flush_triggers()
+    executor.shutdown(wait=True)
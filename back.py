@@ -1,4 +1,113 @@
-from fastapi import FastAPI
+import asyncio
+import hmac
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
-app = FastAPI()
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from aiogram.types import Update
 
+import api
+import bot as shamebot
+import config
+from sharding import FORWARDED_HEADER, shard_of
+from webhook import UpdateQueue
+
+updates = UpdateQueue(
+    shamebot.dp, shamebot.bot, config.WEBHOOK_QUEUE_SIZE, config.WEBHOOK_WORKERS
+)
+
+
+async def start_webhook() -> None:
+    if not config.WEBHOOK_SECRET:
+        # The webhook route is public; without a secret anyone could post
+        # updates to it.
+        raise RuntimeError("SHAMEBOT_WEBHOOK_SECRET is required in webhook mode")
+    updates.start()
+    if config.WEBHOOK_URL:
+        await shamebot.bot.set_webhook(
+            config.WEBHOOK_URL,
+            secret_token=config.WEBHOOK_SECRET,
+            allowed_updates=shamebot.dp.resolve_used_update_types(),
+        )
+        shamebot.logger.info("Webhook set to %s", config.WEBHOOK_URL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # The bot runs inside the API process, so /metrics sees its runtime.
+    await shamebot.on_startup()
+    polling = None
+    if config.BOT_MODE == "webhook":
+        await start_webhook()
+    else:
+        await shamebot.bot.delete_webhook()
+        polling = asyncio.create_task(
+            shamebot.dp.start_polling(shamebot.bot, handle_signals=False)
+        )
+    try:
+        yield
+    finally:
+        if polling is None:
+            await updates.stop(config.WEBHOOK_DRAIN_TIMEOUT)
+        else:
+            if not polling.done():
+                await shamebot.dp.stop_polling()
+            await asyncio.gather(polling, return_exceptions=True)
+        await shamebot.on_shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+app.include_router(api.router)
+
+
+@app.get("/metrics")
+async def metrics() -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.post(config.WEBHOOK_PATH, include_in_schema=False)
+async def webhook(
+    request: Request,
+    secret: str = Header("", alias="X-Telegram-Bot-Api-Secret-Token"),
+) -> Response:
+    if config.BOT_MODE != "webhook":
+        raise HTTPException(404)
+    if not config.WEBHOOK_SECRET or not hmac.compare_digest(
+        secret, config.WEBHOOK_SECRET
+    ):
+        raise HTTPException(403)
+    update = Update.model_validate(await request.json(), context={"bot": shamebot.bot})
+    if not updates.put(update):
+        # Telegram redelivers updates that were not answered with 2xx.
+        raise HTTPException(503)
+    return Response()
+
+
+@app.post("/internal/update", include_in_schema=False)
+async def internal_update(
+    request: Request,
+    secret: str = Header("", alias=FORWARDED_HEADER),
+) -> Response:
+    # Updates of this worker's shards, forwarded by the worker that received
+    # them (see sharding.ShardRouter). They are not forwarded again. Without
+    # a secret nobody can forward, so the route refuses everything.
+    if config.BOT_MODE != "webhook":
+        raise HTTPException(404)
+    if not config.WEBHOOK_SECRET or not hmac.compare_digest(
+        secret, config.WEBHOOK_SECRET
+    ):
+        raise HTTPException(403)
+    update = Update.model_validate(await request.json(), context={"bot": shamebot.bot})
+    chat = getattr(update.event, "chat", None)
+    if chat is None or shard_of(chat.id) not in shamebot.leases.current():
+        # Not ours (any more): the sender handles it itself.
+        raise HTTPException(409)
+    try:
+        await shamebot.dp.feed_update(shamebot.bot, update, forwarded=True)
+    except Exception:
+        # Answering with an error would make the sender handle it again.
+        shamebot.logger.exception(
+            "Failed to process forwarded update %s", update.update_id
+        )
+    return Response()
@@ -0,0 +1,245 @@
+"""Ingress throughput benchmark.
+
+Replays synthetic group updates through `bot.dp` with a stubbed Telegram
+session and a temporary database, e.g.
+
+    python benchmark.py --chats 20 --members 500 --updates 20000
+
+and reports throughput, handler latency percentiles and database queries
+per update. Set SHAMEBOT_DATABASE_URL to benchmark another database.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+from collections import Counter
+from statistics import quantiles
+from time import perf_counter
+
+# Everything the bot writes (database, log file) goes to a scratch directory.
+# This has to happen before bot and database are imported.
+workdir = tempfile.mkdtemp(prefix="shamebot-bench-")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(workdir)
+os.environ.setdefault(
+    "SHAMEBOT_BOT_TOKEN", "123456:benchmark-token-not-used-for-requests"
+)
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetChatAdministrators, SendMessage, TelegramMethod
+from aiogram.types import Message, Update
+from sqlalchemy import event
+
+import async_handlers as adbh
+import bot as shamebot
+import database as db
+
+CONTENT_KINDS = ("text", "photo", "voice", "video_note", "join", "leave")
+
+
+class StubSession(BaseSession):
+    """Answers every API call locally and counts them."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.calls: Counter[str] = Counter()
+
+    async def make_request(
+        self, bot: Bot, method: TelegramMethod, timeout: int | None = None
+    ):
+        self.calls[type(method).__name__] += 1
+        if isinstance(method, SendMessage):
+            return Message.model_validate(
+                {
+                    "message_id": 1,
+                    "date": 0,
+                    "chat": {"id": method.chat_id, "type": "private"},
+                    "text": method.text,
+                }
+            )
+        if isinstance(method, GetChatAdministrators):
+            return []
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        raise NotImplementedError
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+def _user(user_id: int) -> dict:
+    return {
+        "id": user_id,
+        "is_bot": False,
+        "first_name": f"User {user_id}",
+        "username": f"user{user_id}",
+    }
+
+
+def _chat(chat_id: int) -> dict:
+    return {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"}
+
+
+def make_update(update_id: int, kind: str, chat_id: int, user_id: int) -> dict:
+    if kind in ("join", "leave"):
+        old, new = ("left", "member") if kind == "join" else ("member", "left")
+        return {
+            "update_id": update_id,
+            "chat_member": {
+                "chat": _chat(chat_id),
+                "from": _user(user_id),
+                "date": 0,
+                "old_chat_member": {"status": old, "user": _user(user_id)},
+                "new_chat_member": {"status": new, "user": _user(user_id)},
+            },
+        }
+    message = {
+        "message_id": update_id,
+        "date": 0,
+        "chat": _chat(chat_id),
+        "from": _user(user_id),
+    }
+    if kind == "text":
+        message["text"] = "hello"
+    elif kind == "photo":
+        message["photo"] = [
+            {"file_id": "p", "file_unique_id": "p", "width": 1, "height": 1}
+        ]
+    elif kind == "voice":
+        message["voice"] = {"file_id": "v", "file_unique_id": "v", "duration": 1}
+    elif kind == "video_note":
+        message["video_note"] = {
+            "file_id": "n",
+            "file_unique_id": "n",
+            "length": 1,
+            "duration": 1,
+        }
+    return {"update_id": update_id, "message": message}
+
+
+def populate(chats: int, members: int) -> tuple[list[int], list[int]]:
+    chat_ids = [-1_000_000_000_000 - i for i in range(chats)]
+    user_ids = list(range(1, members + 1))
+    with db.Session(db.engine) as session:
+        session.add_all(
+            db.Chat(
+                id=chat_id,
+                chat_name=f"Chat {chat_id}",
+                triggers=db.Trigger.TEXT
+                | db.Trigger.PHOTO
+                | db.Trigger.VOICE
+                | db.Trigger.VIDEO_NOTE
+                | db.Trigger.JOIN,
+                notify_time=3600,
+                notify_max_time=7 * 86400,
+                notify_interval=86400,
+                setup_complete=True,
+            )
+            for chat_id in chat_ids
+        )
+        session.add_all(
+            db.User(id=user_id, user_name=f"user{user_id}") for user_id in user_ids
+        )
+        session.commit()
+        # Half of the users already are members of every chat, the other
+        # half shows up through join events and first messages.
+        session.add_all(
+            db.ChatMember(chat_id=chat_id, user_id=user_id)
+            for chat_id in chat_ids
+            for user_id in user_ids[: members // 2]
+        )
+        session.commit()
+    return chat_ids, user_ids
+
+
+async def run(args: argparse.Namespace) -> None:
+    await adbh.db_init()
+    chat_ids, user_ids = populate(args.chats, args.members)
+    weights = [args.weight[kind] for kind in CONTENT_KINDS]
+    rng = random.Random(args.seed)
+    updates = [
+        Update.model_validate(
+            make_update(
+                update_id,
+                rng.choices(CONTENT_KINDS, weights)[0],
+                rng.choice(chat_ids),
+                rng.choice(user_ids),
+            )
+        )
+        for update_id in range(1, args.updates + 1)
+    ]
+
+    session = StubSession()
+    shamebot.bot.session = session
+    queries = 0
+
+    def count_query(*_) -> None:
+        nonlocal queries
+        queries += 1
+
+    event.listen(db.engine, "before_cursor_execute", count_query)
+    flush_task = asyncio.create_task(adbh.run_trigger_flush())
+
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def feed(update: Update) -> None:
+        async with semaphore:
+            start = perf_counter()
+            await shamebot.dp.feed_update(shamebot.bot, update)
+            latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    await asyncio.gather(*(feed(update) for update in updates))
+    await adbh.flush_triggers()
+    await adbh.compact_activity()
+    elapsed = perf_counter() - start
+    flush_task.cancel()
+    await adbh.shutdown()
+
+    p50, p99 = (quantiles(latencies, n=100)[i] for i in (49, 98))
+    print(f"workdir:         {workdir}")
+    print(f"database:        {db.engine.url.render_as_string()}")
+    print(f"updates:         {len(updates)} ({args.chats} chats, {args.members} users)")
+    print(f"concurrency:     {args.concurrency}")
+    print(f"throughput:      {len(updates) / elapsed:,.0f} updates/s")
+    print(f"latency p50:     {p50 * 1000:.3f} ms")
+    print(f"latency p99:     {p99 * 1000:.3f} ms")
+    print(f"queries/update:  {queries / len(updates):.3f}")
+    print(f"api calls:       {dict(session.calls) or 0}")
+
+
+def parse_weights(value: str) -> dict[str, float]:
+    weights = dict.fromkeys(CONTENT_KINDS, 0.0)
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in weights:
+            raise argparse.ArgumentTypeError(f"unknown update kind {kind!r}")
+        weights[kind] = float(weight)
+    return weights
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--weight",
+        type=parse_weights,
+        default="text=70,photo=10,voice=8,video_note=7,join=3,leave=2",
+        help="relative frequency of each update kind, e.g. text=9,join=1",
+    )
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@ import asyncio
 import logging
 import sys
 from os import getenv
-from time import time
+from time import perf_counter, time
 
 from aiogram import Bot, Dispatcher, html, Router, F
 from aiogram.client.default import DefaultBotProperties
@@ -10,69 +10,112 @@ from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart
 from aiogram.types import Message, ChatMemberUpdated, Chat, chat_member_banned
 from aiogram.exceptions import TelegramForbiddenError
-import db_handlers as dbh
+import async_handlers as adbh
+import snapshot
+from db_handlers import CONTENT_TYPE_TRIGGERS, SleepyMember, ignores_message
+import config
+from logs import setup_logging
+from metrics import (
+    NOTIFICATIONS,
+    NOTIFY_CYCLE_SECONDS,
+    MetricsMiddleware,
+    monitor_event_loop,
+)
+from scheduler import Wakeup
+from sender import Sender
+from sharding import ShardLeases, ShardRouter
 
 # import database as db
 
-from keys import token
+token = config.BOT_TOKEN
+if not token:
+    from keys import token
 
 import logging
 
-logging.basicConfig(
-    filename="bot.log", level=logging.INFO, encoding="utf-8", filemode="w", force=True
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 bot = Bot(token)
 
+sender = Sender(
+    bot,
+    config.SEND_RATE,
+    config.SEND_CHAT_RATE,
+    config.SEND_CONCURRENCY,
+    config.SEND_MAX_RETRIES,
+)
+
 dp = Dispatcher()
+for observer in (dp.message, dp.chat_member, dp.my_chat_member):
+    observer.middleware(MetricsMiddleware())
+
+notifier_wakeup = Wakeup()
+
+leases = ShardLeases(
+    config.WORKER_ID,
+    config.WORKER_ADDRESS,
+    config.SHARD_COUNT,
+    config.SHARD_LEASE_TTL,
+)
+shard_router = ShardRouter(leases, config.WEBHOOK_SECRET)
+dp.update.outer_middleware(shard_router)
 
 
 @dp.message(CommandStart())
 # Handler for the /start command
 async def command_start_handler(message: Message) -> None:
     logger.info(
-        f"Got '/start' command from '@{message.from_user.username if message.from_user else 'unknown'}'"
+        "Got '/start' command from '@%s'",
+        message.from_user.username if message.from_user else "unknown",
     )
     await message.answer(
         'Привет!\n\nЯ бот для управления уведомления о "спящих" участниках в групповых чатах.\n\nМеня нужно добавить в групповой чат и назначить администратором, чтобы я мог видеть сообщения участников и помогать с уведомлениями.\n\nСправишься?'
     )
 
 
-@dp.message((F.text | F.photo | F.voice | F.video_note | F.video) & (F.chat.id < 0))
+@dp.message(F.content_type.in_(CONTENT_TYPE_TRIGGERS) & (F.chat.id < 0))
 # Handler for media messages in group chats
 async def media_handler(message: Message) -> None:
+    if ignores_message(message):
+        return
     logger.info(
-        f"Got message of type {message.content_type} from '@{message.from_user.username if message.from_user else 'unknown'}' in chat '{message.chat.title}'"
+        "Got message of type %s from '@%s' in chat '%s'",
+        message.content_type,
+        message.from_user.username if message.from_user else "unknown",
+        message.chat.title,
     )
-    dbh.got_message(message)
+    await adbh.got_message(message)
 
 
 @dp.message(F.left_chat_member)
 async def left_chat_member_handler(message: Message) -> None:
     logger.info(
-        f"Got F.left_chat_member message in chat '@{message.chat.title}'. Ignoring."
+        "Got F.left_chat_member message in chat '@%s'. Ignoring.", message.chat.title
     )
 
 
 @dp.message(F.new_chat_members)
 async def new_chat_members_handler(message: Message) -> None:
     logger.info(
-        f"Got F.new_chat_members message in chat '@{message.chat.title}'. Ignoring."
+        "Got F.new_chat_members message in chat '@%s'. Ignoring.", message.chat.title
     )
 
 
 @dp.message(F.text & (F.chat.id > 0))
 async def private_chat_message_handler(message: Message) -> None:
     logger.info(
-        f"Got text message from '@{message.from_user.username if message.from_user else 'unknown'}' in private chat: {message.text}"
+        "Got text message from '@%s' in private chat: %s",
+        message.from_user.username if message.from_user else "unknown",
+        message.text,
     )
 
 
 @dp.message(~F.text & (F.chat.id > 0))
 async def private_chat_non_text_message_handler(message: Message) -> None:
     logger.info(
-        f"Got non-text message from '@{message.from_user.username if message.from_user else 'unknown'}' in private chat."
+        "Got non-text message from '@%s' in private chat.",
+        message.from_user.username if message.from_user else "unknown",
     )
     await message.answer(
         "Я не знаю, как на это ответить.\n\nПопробуй описать словами, что тебе нужно."
@@ -82,7 +125,13 @@ async def private_chat_non_text_message_handler(message: Message) -> None:
 @dp.message()
 # Default handler for unhandled messages
 async def default_message_handler(message: Message) -> None:
-    logger.info(f"Unhandled message: {type(message)}: {message}")
+    # Only a summary; formatting the whole Message is expensive.
+    logger.info(
+        "Unhandled message %s of type %s in chat %s",
+        message.message_id,
+        message.content_type,
+        message.chat.id,
+    )
 
 
 @dp.my_chat_member(
@@ -91,7 +140,9 @@ async def default_message_handler(message: Message) -> None:
     & (F.old_chat_member.status == "administrator")
 )
 async def bot_demoted_handler(data: ChatMemberUpdated) -> None:
-    logger.info(f"Bot lost admin rights in chat: {data.chat.id} - '{data.chat.title}'")
+    logger.info(
+        "Bot lost admin rights in chat: %s - '%s'", data.chat.id, data.chat.title
+    )
     try:
         await bot.send_message(
             data.from_user.id,
@@ -99,7 +150,8 @@ async def bot_demoted_handler(data: ChatMemberUpdated) -> None:
         )
     except TelegramForbiddenError:
         logger.warning(
-            f"Cannot send message to user {data.from_user.id}. They might have blocked the bot or didn't start a chat."
+            "Cannot send message to user %s. They might have blocked the bot or didn't start a chat.",
+            data.from_user.id,
         )
 
 
@@ -107,7 +159,7 @@ async def bot_demoted_handler(data: ChatMemberUpdated) -> None:
 # Handler for when the bot is added to a chat
 async def bot_added_handler(data: ChatMemberUpdated) -> None:
     logger.info(
-        f"Bot was added to chat '@{data.chat.title}' by '@{data.from_user.username}'"
+        "Bot was added to chat '@%s' by '@%s'", data.chat.title, data.from_user.username
     )
     try:
         await bot.send_message(
@@ -116,23 +168,26 @@ async def bot_added_handler(data: ChatMemberUpdated) -> None:
         )
     except TelegramForbiddenError:
         logger.warning(
-            f"Cannot send message to user '@{data.from_user.id}'. They might have blocked the bot or didn't start a chat."
+            "Cannot send message to user '@%s'. They might have blocked the bot or didn't start a chat.",
+            data.from_user.id,
         )
-    dbh.bot_added_to_chat(data.chat, data.from_user)
+    await adbh.bot_added_to_chat(data.chat, data.from_user)
     # dbh.setup_test_chat(data.chat.id)
 
 
 @dp.my_chat_member((F.new_chat_member.status == "member") & (F.chat.id > 0))
 # Handler for when the bot is started in a private chat
 async def bot_started_private_chat_handler(data: ChatMemberUpdated) -> None:
-    logger.info(f"'@{data.from_user.username}' started private chat with bot.")
+    logger.info("'@%s' started private chat with bot.", data.from_user.username)
 
 
 @dp.my_chat_member(F.new_chat_member.status.in_({"left", "kicked"}))
 # Handler for when the bot is removed from a chat
 async def bot_left_handler(data: ChatMemberUpdated) -> None:
     logger.info(
-        f"Bot was kicked from chat '@{data.chat.title}' by '@{data.from_user.username}'"
+        "Bot was kicked from chat '@%s' by '@%s'",
+        data.chat.title,
+        data.from_user.username,
     )
     try:
         await bot.send_message(
@@ -141,19 +196,23 @@ async def bot_left_handler(data: ChatMemberUpdated) -> None:
         )
     except TelegramForbiddenError:
         logger.warning(
-            f"Cannot send message to user '@{data.from_user.id}'. They might have blocked the bot or didn't start a chat."
+            "Cannot send message to user '@%s'. They might have blocked the bot or didn't start a chat.",
+            data.from_user.id,
         )
-    dbh.bot_deleted_from_chat(data.chat)
+    await adbh.bot_deleted_from_chat(data.chat)
 
 
 @dp.my_chat_member(F.new_chat_member.status == "administrator")
 # Handler for when the bot is made an admin in a chat
 async def bot_made_admin_handler(data: ChatMemberUpdated) -> None:
     logger.info(
-        f"Bot was made admin in chat: '{data.chat.id}' - '{data.chat.title}' by '@{data.from_user.username}'"
+        "Bot was made admin in chat: '%s' - '%s' by '@%s'",
+        data.chat.id,
+        data.chat.title,
+        data.from_user.username,
     )
     try:
-        if not dbh.chat_setup_complete(data.chat):
+        if not await adbh.chat_setup_complete(data.chat):
             await bot.send_message(
                 data.from_user.id,
                 f"Ага\\! Вижу вы назначили меня администратором в чате {data.chat.title}\\! Теперь можем приступить к [настройке](http://localhost:8501/?admin={data.from_user.id})",
@@ -166,17 +225,21 @@ async def bot_made_admin_handler(data: ChatMemberUpdated) -> None:
             )
     except TelegramForbiddenError:
         logger.warning(
-            f"Cannot send message to user {data.from_user.id}. They might have blocked the bot or didn't start a chat."
+            "Cannot send message to user %s. They might have blocked the bot or didn't start a chat.",
+            data.from_user.id,
         )
     admins = await bot.get_chat_administrators(data.chat.id)
-    dbh.add_chat_admins(data.chat, admins)
+    await adbh.add_chat_admins(data.chat, admins)
     # dbh.setup_test_chat(data.chat.id)
 
 
 @dp.my_chat_member()
 async def my_chat_member_handler(my_chat_member: ChatMemberUpdated) -> None:
     logger.info(
-        f"Unhandled my_chat_member event: {type(my_chat_member.new_chat_member)}: {my_chat_member.new_chat_member}"
+        "Unhandled my_chat_member event in chat %s: %s -> %s",
+        my_chat_member.chat.id,
+        my_chat_member.old_chat_member.status,
+        my_chat_member.new_chat_member.status,
     )
 
 
@@ -186,17 +249,22 @@ async def my_chat_member_handler(my_chat_member: ChatMemberUpdated) -> None:
 )
 async def user_demoted_handler(data: ChatMemberUpdated) -> None:
     logger.info(
-        f"User '@{data.new_chat_member.user.username}' lost 'admin' status in chat '{data.chat.title}'"
+        "User '@%s' lost 'admin' status in chat '%s'",
+        data.new_chat_member.user.username,
+        data.chat.title,
     )
-    dbh.demote_user_to_member(data.chat.id, data.new_chat_member.user)
+    await adbh.demote_user_to_member(data.chat.id, data.new_chat_member.user)
 
 
 @dp.chat_member(F.new_chat_member.status == "member")
 async def user_added_handler(data: ChatMemberUpdated) -> None:
     logger.info(
-        f"User '@{data.new_chat_member.user.username}' was added to '@{data.chat.title}' by '@{data.from_user.username}'"
+        "User '@%s' was added to '@%s' by '@%s'",
+        data.new_chat_member.user.username,
+        data.chat.title,
+        data.from_user.username,
     )
-    dbh.user_joined_chat(data.chat.id, data.new_chat_member.user)
+    await adbh.user_joined_chat(data.chat.id, data.new_chat_member.user)
 
 
 @dp.chat_member(
@@ -204,76 +272,206 @@ async def user_added_handler(data: ChatMemberUpdated) -> None:
 )
 async def user_left_handler(data: ChatMemberUpdated) -> None:
     logger.info(
-        f"User '@{data.new_chat_member.user.username}' left the chat '{data.chat.title}'"
+        "User '@%s' left the chat '%s'",
+        data.new_chat_member.user.username,
+        data.chat.title,
     )
-    dbh.user_left_chat(data.chat.id, data.new_chat_member.user.id)
+    await adbh.user_left_chat(data.chat.id, data.new_chat_member.user.id)
 
 
 @dp.chat_member(F.new_chat_member.status == "administrator")
 async def user_made_admin_handler(data: ChatMemberUpdated) -> None:
     logger.info(
-        f"User '@{data.new_chat_member.user.username}' was made admin in chat '{data.chat.title}'"
+        "User '@%s' was made admin in chat '%s'",
+        data.new_chat_member.user.username,
+        data.chat.title,
     )
-    dbh.promote_user_to_admin(data.chat.id, data.new_chat_member.user)
+    await adbh.promote_user_to_admin(data.chat.id, data.new_chat_member.user)
 
 
 @dp.chat_member()
 async def chat_member_handler(chat_member: ChatMemberUpdated) -> None:
-    logger.info(f"Unhandled chat_member event: {type(chat_member)}: {chat_member}")
+    logger.info(
+        "Unhandled chat_member event in chat %s for user %s: %s -> %s",
+        chat_member.chat.id,
+        chat_member.new_chat_member.user.id,
+        chat_member.old_chat_member.status,
+        chat_member.new_chat_member.status,
+    )
+
+
+# Telegram rejects messages longer than this.
+MESSAGE_LIMIT = 4096
+
+
+def digest_messages(sleepy_members: list[SleepyMember]) -> list[tuple[int, str]]:
+    # admin_id -> chat_id -> sleepy user names; chat names need not be unique.
+    digests: dict[int, dict[int, list[str]]] = {}
+    chat_names: dict[int, str] = {}
+    for member in sleepy_members:
+        chat_names[member.chat_id] = member.chat_name
+        for admin_id, admin_name in member.admins:
+            digests.setdefault(admin_id, {}).setdefault(member.chat_id, []).append(
+                member.user_name
+            )
+    header = "Привет! Похоже эти участники давно не проявляли активности:\n"
+    footer = "\nНапомни им правила чата!"
+    messages = []
+    for admin_id, chats in digests.items():
+        logger.info(
+            "Sending digest about %s sleepy members in %s chats to %s",
+            sum(map(len, chats.values())),
+            len(chats),
+            admin_id,
+        )
+        text = header
+        for chat_id, user_names in chats.items():
+            chat_line = f"\nЧат {chat_names[chat_id]}:\n"
+            lines = chat_line
+            for user_name in user_names:
+                lines += f"@{user_name}\n"
+                if len(text) + len(lines) + len(footer) > MESSAGE_LIMIT:
+                    messages.append((admin_id, text + footer))
+                    text = header
+                    lines = chat_line + f"@{user_name}\n"
+                text += lines
+                lines = ""
+        messages.append((admin_id, text + footer))
+    return messages
+
+
+async def notify_shards(cycle_time: float, shards: frozenset[int]) -> None:
+    sleepy_members = await adbh.get_sleepy_members(cycle_time, shards)
+    if config.NOTIFY_DIGEST:
+        messages = digest_messages(sleepy_members)
+    else:
+        messages = []
+        for member in sleepy_members:
+            logger.info(
+                "Notifying admins about sleepy member '@%s' in chat '@%s'",
+                member.user_name,
+                member.chat_name,
+            )
+            for admin_id, admin_name in member.admins:
+                messages.append(
+                    (
+                        admin_id,
+                        f"Привет! Похоже @{member.user_name} давно не проявлял активности в чате {member.chat_name}. Напомни ему правила чата!",
+                    )
+                )
+    stats = await sender.send_all(messages)
+    for result in ("sent", "forbidden", "retried", "failed"):
+        NOTIFICATIONS.labels(result).inc(getattr(stats, result))
+    if sleepy_members:
+        logger.info("Updating last_notify_time for %s members", len(sleepy_members))
+        await adbh.set_last_notify_time(
+            [(member.chat_id, member.user_id) for member in sleepy_members], time()
+        )
 
 
 async def notify_sleepy_members() -> None:
     while True:
-        # logger.info("Running notify_sleepy_members task")
-        with dbh.get_session() as session:
-            chats = dbh.get_chats_to_notify(session)
-            logger.info(f"Searching for chats to notify.")
-            for chat in chats:
-                logger.info(f"Checking chat '@{chat.chat_name}' for sleepy members.")
-                for membership in dbh.get_members_to_notify_by_chat(
-                    session, chat, time()
-                ):
-                    # if (
-                    #     not membership.is_muted
-                    #     and membership.last_trigger_time
-                    #     and (time() - membership.last_trigger_time) > chat.notify_time
-                    #     and (time() - membership.last_trigger_time)
-                    #     < chat.notify_max_time
-                    #     and (time() - membership.last_notify_time)
-                    #     > chat.notify_interval
-                    # ):
-                    logger.info(
-                        f"Notifying admins about sleepy member '@{membership.user.user_name}' in chat '@{chat.chat_name}'"
-                    )
-                    user = membership.user
-                    for admin_membership in chat.admin_memberships:
-                        if not admin_membership.is_muted:
-                            admin = admin_membership.user
-                            try:
-                                await bot.send_message(
-                                    admin.id,
-                                    f"Привет! Похоже @{user.user_name} давно не проявлял активности в чате {chat.chat_name}. Напомни ему правила чата!",
-                                )
-                                logger.info(
-                                    f"Notified '@{admin.user_name}' about inactivity of '@{user.user_name}' in chat '@{chat.chat_name}'"
-                                )
-                            except TelegramForbiddenError:
-                                logger.warning(
-                                    f"Cannot send notification to user @{admin.user_name}. They might have blocked the bot or didn't start a chat."
-                                )
-                    logger.info(
-                        f"Updating last_notify_time for '@{membership.user.user_name}' in chat '@{chat.chat_name}'"
-                    )
-                    membership.last_notify_time = time()
-        await asyncio.sleep(60)
+        logger.info("Searching for chats to notify.")
+        cycle_time = time()
+        cycle_start = perf_counter()
+        # Keep our shards until the cycle is done. Reading them through the
+        # DB executor lets a lease renewal that is already running finish.
+        leases.hold = True
+        try:
+            shards = await adbh.run(leases.current)
+            if shards:
+                await notify_shards(cycle_time, shards)
+            wake_at = time() + config.NOTIFIER_MAX_SLEEP
+            next_notify_time = await adbh.get_next_notify_time(shards)
+            if next_notify_time is not None and next_notify_time < wake_at:
+                wake_at = next_notify_time
+        except Exception:
+            # Try again after the usual maximum sleep, or sooner when woken.
+            logger.exception("Failed to notify sleepy members.")
+            wake_at = time() + config.NOTIFIER_MAX_SLEEP
+        finally:
+            leases.hold = False
+        NOTIFY_CYCLE_SECONDS.observe(perf_counter() - cycle_start)
+        await notifier_wakeup.sleep_until(wake_at)
+
+
+async def compact_activity() -> None:
+    while True:
+        await asyncio.sleep(config.ACTIVITY_COMPACT_INTERVAL)
+        try:
+            shards = await adbh.run(leases.current)
+            if shards:
+                await adbh.compact_activity(shards)
+        except Exception:
+            logger.exception("Failed to compact the activity log.")
 
 
-async def main() -> None:
-    dbh.db_init()
+async def save_snapshots() -> None:
+    while True:
+        await asyncio.sleep(config.SNAPSHOT_INTERVAL)
+        try:
+            await adbh.run(snapshot.save, config.SNAPSHOT_FILE)
+        except Exception:
+            logger.exception("Failed to save the cache snapshot.")
+
+
+background_tasks: list[asyncio.Task] = []
+
+
+async def on_startup() -> None:
+    await adbh.db_init()
+    await adbh.refresh_all_next_notify_times()
+    if config.SNAPSHOT_FILE:
+        loaded = await adbh.run(snapshot.load, config.SNAPSHOT_FILE)
+        logger.info("Warmed up caches with %s snapshot entries", loaded)
+        background_tasks.append(asyncio.create_task(save_snapshots()))
+    await adbh.run(leases.renew)
+    background_tasks.append(
+        asyncio.create_task(
+            leases.run(
+                config.SHARD_LEASE_RENEW,
+                adbh.executor,
+                lambda: notifier_wakeup.request(time()),
+            )
+        )
+    )
+    loop = asyncio.get_running_loop()
+    adbh.next_notify_listeners.append(
+        lambda at: loop.call_soon_threadsafe(notifier_wakeup.request, at)
+    )
     logger.info("Starting notify_sleepy_members task")
-    asyncio.create_task(notify_sleepy_members())
+    background_tasks.append(asyncio.create_task(notify_sleepy_members()))
+    logger.info("Starting trigger buffer flush task")
+    background_tasks.append(asyncio.create_task(adbh.run_trigger_flush()))
+    background_tasks.append(asyncio.create_task(compact_activity()))
+    background_tasks.append(asyncio.create_task(monitor_event_loop()))
+
+
+async def on_shutdown() -> None:
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await shard_router.close()
+    await adbh.run(leases.release_all)
+    if config.SNAPSHOT_FILE:
+        try:
+            await adbh.run(snapshot.save, config.SNAPSHOT_FILE)
+        except Exception:
+            logger.exception("Failed to save the cache snapshot.")
+    logger.info("Flushing pending trigger updates")
+    await adbh.shutdown()
+
+
+async def main() -> None:
+    await on_startup()
     logger.info("Starting polling")
-    await dp.start_polling(bot)
+    try:
+        # getUpdates is refused while a webhook is registered.
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+    finally:
+        await on_shutdown()
 
 
 if __name__ == "__main__":
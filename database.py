@@ -1,38 +1,158 @@
-from sqlmodel import Field, Session, SQLModel, create_engine, select, Relationship
+import sys
+from enum import IntFlag
+
+from sqlmodel import (
+    Field,
+    Session,
+    SQLModel,
+    create_engine,
+    select,
+    update,
+    case,
+    func,
+    null,
+    or_,
+    tuple_,
+    delete,
+    bindparam,
+    insert,
+    literal,
+    Relationship,
+)
+from sqlalchemy import BigInteger, Engine, Index, Integer, event
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.dialects import postgresql, sqlite
+
+import config
+
+# Telegram ids do not fit in 32 bits. SQLite integers are 64-bit anyway, and
+# keeping INTEGER there leaves existing SQLite schemas unchanged.
+Id = BigInteger().with_variant(Integer(), "sqlite")
+
+# Dialects with INSERT ... ON CONFLICT support.
+_upsert_inserts = {
+    "sqlite": sqlite.insert,
+    "postgresql": postgresql.insert,
+}
+
+
+def insert_or_ignore(session: Session, model: type[SQLModel], **values) -> bool:
+    # INSERT ... ON CONFLICT DO NOTHING; tells whether a row was inserted.
+    dialect_insert = _upsert_inserts.get(session.get_bind().dialect.name)
+    if dialect_insert is None:
+        primary_key = tuple(
+            values[column.name] for column in model.__table__.primary_key
+        )
+        if session.get(model, primary_key):
+            return False
+        session.execute(insert(model).values(**values))
+        return True
+    result = session.execute(
+        dialect_insert(model).values(**values).on_conflict_do_nothing()
+    )
+    return result.rowcount > 0
+
+
+def insert_or_ignore_many(
+    session: Session, model: type[SQLModel], rows: list[dict]
+) -> None:
+    # Bulk insert_or_ignore: one executemany INSERT ... ON CONFLICT DO NOTHING.
+    if not rows:
+        return
+    dialect_insert = _upsert_inserts.get(session.get_bind().dialect.name)
+    if dialect_insert is None:
+        for values in rows:
+            insert_or_ignore(session, model, **values)
+        return
+    session.execute(dialect_insert(model).on_conflict_do_nothing(), rows)
+
+
+def delete_link(
+    session: Session,
+    model: "type[ChatAdmin] | type[ChatMember]",
+    user_id: int,
+    chat_id: int,
+) -> bool:
+    result = session.execute(
+        delete(model).where(model.user_id == user_id, model.chat_id == chat_id)
+    )
+    return result.rowcount > 0
+
+
+class Trigger(IntFlag):
+    # Bits of Chat.triggers: the events that count as activity in a chat.
+    # A new trigger type is a new bit here, not a new column.
+    TEXT = 1
+    PHOTO = 2
+    VIDEO = 4
+    VOICE = 8
+    VIDEO_NOTE = 16
+    JOIN = 32
 
 
 class ChatAdmin(SQLModel, table=True):
-    user_id: int = Field(foreign_key="user.id", primary_key=True)
-    chat_id: int = Field(foreign_key="chat.id", primary_key=True)
+    user_id: int = Field(foreign_key="user.id", primary_key=True, sa_type=Id)
+    chat_id: int = Field(foreign_key="chat.id", primary_key=True, sa_type=Id)
     is_muted: bool = Field(default=False)
     chat: "Chat" = Relationship(sa_relationship_kwargs={"viewonly": True})
     user: "User" = Relationship(sa_relationship_kwargs={"viewonly": True})
 
+    # The primary key leads with user_id; chat pages are read by chat_id.
+    __table_args__ = (Index("ix_chatadmin_chat_user", "chat_id", "user_id"),)
+
     @classmethod
     def get(cls, session: Session, user_id: int, chat_id: int) -> "ChatAdmin | None":
         return session.exec(
             select(ChatAdmin).where(cls.user_id == user_id, cls.chat_id == chat_id)
         ).first()
 
+    @classmethod
+    def add(cls, session: Session, user_id: int, chat_id: int, **values) -> bool:
+        return insert_or_ignore(
+            session, cls, user_id=user_id, chat_id=chat_id, **values
+        )
+
+    @classmethod
+    def remove(cls, session: Session, user_id: int, chat_id: int) -> bool:
+        return delete_link(session, cls, user_id, chat_id)
+
 
 class ChatMember(SQLModel, table=True):
-    user_id: int = Field(foreign_key="user.id", primary_key=True)
-    chat_id: int = Field(foreign_key="chat.id", primary_key=True)
+    user_id: int = Field(foreign_key="user.id", primary_key=True, sa_type=Id)
+    chat_id: int = Field(foreign_key="chat.id", primary_key=True, sa_type=Id)
     last_trigger_time: float = Field(default=0.0)
     last_notify_time: float = Field(default=0.0)
+    # Earliest time the member may need a notification, None if never.
+    # Maintained by db_handlers.refresh_next_notify_time.
+    next_notify_time: float | None = Field(default=None, index=True)
     is_muted: bool = Field(default=False)
     chat: "Chat" = Relationship(sa_relationship_kwargs={"viewonly": True})
     user: "User" = Relationship(sa_relationship_kwargs={"viewonly": True})
 
+    __table_args__ = (
+        # Keyset pages of a chat's members (read_model.chat_members_page).
+        Index("ix_chatmember_chat_user", "chat_id", "user_id"),
+    )
+
     @classmethod
     def get(cls, session: Session, user_id: int, chat_id: int) -> "ChatMember | None":
         return session.exec(
             select(ChatMember).where(cls.user_id == user_id, cls.chat_id == chat_id)
         ).first()
 
+    @classmethod
+    def add(cls, session: Session, user_id: int, chat_id: int, **values) -> bool:
+        return insert_or_ignore(
+            session, cls, user_id=user_id, chat_id=chat_id, **values
+        )
+
+    @classmethod
+    def remove(cls, session: Session, user_id: int, chat_id: int) -> bool:
+        return delete_link(session, cls, user_id, chat_id)
+
 
 class User(SQLModel, table=True):
-    id: int = Field(primary_key=True)
+    id: int = Field(primary_key=True, sa_type=Id)
     user_name: str = Field(default="")
     admin_in: list["Chat"] = Relationship(
         back_populates="admins",
@@ -49,9 +169,13 @@ class User(SQLModel, table=True):
         sa_relationship_kwargs={"viewonly": True}
     )
 
+    @classmethod
+    def add(cls, session: Session, user_id: int, user_name: str) -> bool:
+        return insert_or_ignore(session, cls, id=user_id, user_name=user_name)
+
 
 class Chat(SQLModel, table=True):
-    id: int = Field(primary_key=True)
+    id: int = Field(primary_key=True, sa_type=Id)
     chat_name: str = Field(default="")
     admins: list[User] = Relationship(
         back_populates="admin_in",
@@ -68,16 +192,62 @@ class Chat(SQLModel, table=True):
         sa_relationship_kwargs={"viewonly": True}
     )
 
-    text_triggers: bool = Field(default=False)
-    photo_triggers: bool = Field(default=False)
-    video_triggers: bool = Field(default=False)
-    voice_triggers: bool = Field(default=False)
-    video_note_triggers: bool = Field(default=False)
-    join_triggers: bool = Field(default=False)
+    # Trigger bits.
+    triggers: int = Field(default=0)
     notify_time: float = Field(default=0.0)
     notify_max_time: float = Field(default=0.0)
     notify_interval: float = Field(default=0.0)
     setup_complete: bool = Field(default=False)
+    # Bumped by every write to the chat's settings, admins or members, so
+    # that processes caching them can tell; see db_handlers.sync_chat_versions.
+    version: int = Field(default=0)
+
+    @classmethod
+    def add(cls, session: Session, chat_id: int, chat_name: str) -> bool:
+        return insert_or_ignore(session, cls, id=chat_id, chat_name=chat_name)
+
+
+class ActivityEvent(SQLModel, table=True):
+    # Append-only log of member activity, folded into
+    # ChatMember.last_trigger_time by db_handlers.compact_activity. No foreign
+    # keys, so appends check nothing and history outlives its chats.
+    id: int | None = Field(default=None, primary_key=True, sa_type=Id)
+    chat_id: int = Field(sa_type=Id)
+    user_id: int = Field(sa_type=Id)
+    content_type: str = Field(default="")
+    # When the trigger happened...
+    ts: float = Field(index=True)
+    # ...and when the event was inserted, which may be much later if the
+    # buffer had to retry.
+    inserted_at: float = Field(default=0.0)
+
+    # Folding is tracked by id, so ids must never be reused; without
+    # AUTOINCREMENT SQLite starts over at 1 once the log is trimmed empty.
+    __table_args__ = {"sqlite_autoincrement": True}
+
+
+class Checkpoint(SQLModel, table=True):
+    # Progress of background jobs, e.g. the last activity event id folded
+    # into the memberships of a shard.
+    name: str = Field(primary_key=True)
+    value: int = Field(default=0, sa_type=Id)
+
+
+class Worker(SQLModel, table=True):
+    # Heartbeat of a running bot process; see sharding.py.
+    id: str = Field(primary_key=True)
+    address: str = Field(default="")
+    expires_at: float = Field(default=0.0)
+
+
+class ShardLease(SQLModel, table=True):
+    # Chats are partitioned into config.SHARD_COUNT shards by chat id; a
+    # shard belongs to worker_id until expires_at.
+    shard: int = Field(
+        primary_key=True, sa_type=Integer, sa_column_kwargs={"autoincrement": False}
+    )
+    worker_id: str | None = Field(default=None)
+    expires_at: float = Field(default=0.0)
 
 
 def members_to_notify_by_chat(
@@ -97,7 +267,23 @@ def members_to_notify_by_chat(
     return members_to_notify
 
 
-engine = create_engine("sqlite:///database.db")
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for pragma, value in config.SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+def create_db_engine(profile: str) -> Engine:
+    """Create the engine for a process profile from config.ENGINE_PROFILES."""
+    engine = create_engine(config.DATABASE_URL, **config.ENGINE_PROFILES[profile])
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+PROFILE = config.DB_PROFILE or ("panel" if "streamlit" in sys.modules else "bot")
+engine = create_db_engine(PROFILE)
 
 
 def db_init() -> None:
@@ -1,12 +1,16 @@
 from math import log
 from modulefinder import Module
-from typing import Generator, TYPE_CHECKING
+from typing import Callable, Collection, Generator, NamedTuple, TYPE_CHECKING
 
 import sys
 
 
 if TYPE_CHECKING:
+    import numpy as np
+
     import database as db
+    import member_store
+    from read_model import ChatView
 else:
     if "streamlit" in sys.modules:
         import streamlit as st
@@ -23,23 +27,33 @@ else:
 
 import aiogram.types as atypes
 import logging
+from threading import Lock
 from time import time
 from contextlib import contextmanager
 
+import config
+from cache import MISSING, TTLCache
+from sharding import shard_of
+from trigger_buffer import Activity, TriggerBuffer
+
 logger = logging.getLogger(__name__)
 
 
 def db_init() -> None:
     db.SQLModel.metadata.create_all(db.engine)
+    # Nothing is cached yet.
+    sync_chat_versions()
+    if store is not None:
+        _load_store()
 
 
 def add_chat(chat: atypes.Chat) -> None:
     new_chat = db.Chat(id=chat.id, chat_name=chat.title if chat.title else "")
-    logger.info(f"Adding new chat: {new_chat}")
+    logger.info("Adding new chat: %s", new_chat)
     with db.Session(db.engine) as session:
         db_chat = session.get(db.Chat, chat.id)
         if db_chat:
-            logger.info(f"Chat with id {chat.id} already exists in database.")
+            logger.info("Chat with id %s already exists in database.", chat.id)
             return
         else:
             session.add(new_chat)
@@ -48,11 +62,11 @@ def add_chat(chat: atypes.Chat) -> None:
 
 def add_user(user: atypes.User) -> None:
     new_user = db.User(id=user.id, user_name=user.username if user.username else "")
-    logger.info(f"Adding new user: {new_user}")
+    logger.info("Adding new user: %s", new_user)
     with db.Session(db.engine) as session:
         db_user = session.get(db.User, user.id)
         if db_user:
-            logger.info(f"User with id {user.id} already exists in database.")
+            logger.info("User with id %s already exists in database.", user.id)
             return
         else:
             session.add(new_user)
@@ -61,290 +75,1053 @@ def add_user(user: atypes.User) -> None:
 
 def bot_added_to_chat(chat: atypes.Chat, user: atypes.User) -> None:
     with db.Session(db.engine) as session:
-        db_chat = session.get(db.Chat, chat.id)
-        if db_chat:
-            logger.info(f"Chat with id {chat.id} already exists in database.")
+        if db.Chat.add(session, chat.id, chat.title if chat.title else ""):
+            logger.info("Added new chat '@%s' to database", chat.title)
         else:
-            db_chat = db.Chat(id=chat.id, chat_name=chat.title if chat.title else "")
-            session.add(db_chat)
-            logger.info(f"Added new chat '@{chat.title}' to database")
-        db_user = session.get(db.User, user.id)
-        if db_user:
-            logger.info(f"User with id {user.id} already exists in database.")
+            logger.info("Chat with id %s already exists in database.", chat.id)
+        if db.User.add(session, user.id, user.username if user.username else ""):
+            logger.info("Added new user '@%s' to database.", user.username)
         else:
-            db_user = db.User(
-                id=user.id, user_name=user.username if user.username else ""
-            )
-            session.add(db_user)
-            logger.info(f"Added new user '@{user.username}' to database.")
-        if db_user not in db_chat.members:
-            db_chat.members.append(db_user)
+            logger.info("User with id %s already exists in database.", user.id)
+        if db.ChatMember.add(session, user.id, chat.id):
             logger.info(
-                f"Added user '@{db_user.user_name}' to members of chat '@{db_chat.chat_name}'"
+                "Added user '@%s' to members of chat '@%s'", user.username, chat.title
             )
         else:
             logger.info(
-                f"User '@{db_user.user_name}' already is a member of chat '@{db_chat.chat_name}'"
+                "User '@%s' already is a member of chat '@%s'",
+                user.username,
+                chat.title,
             )
+        version = _bump_version(session, chat.id)
         session.commit()
+    invalidate_chat(chat.id, version)
 
 
 def bot_deleted_from_chat(chat: atypes.Chat) -> None:
     with db.Session(db.engine) as session:
         db_chat = session.get(db.Chat, chat.id)
         if db_chat:
-            logger.info(f"Deleting chat '@{chat.title}' from database.")
+            logger.info("Deleting chat '@%s' from database.", chat.title)
             session.delete(db_chat)
             session.commit()
+            invalidate_chat(chat.id, None)
         else:
-            logger.info(f"Chat with id {chat.id} not found in database.")
+            logger.info("Chat with id %s not found in database.", chat.id)
 
 
 def chat_setup_complete(chat: atypes.Chat) -> bool:
-    logger.info(f"Checking if setup is complete for chat id {chat.id} - '{chat.title}'")
+    logger.info(
+        "Checking if setup is complete for chat id %s - '%s'", chat.id, chat.title
+    )
     with db.Session(db.engine) as session:
         db_chat = session.get(db.Chat, chat.id)
         if db_chat:
-            logger.info(f"setup_complete = {db_chat.setup_complete}")
+            logger.info("setup_complete = %s", db_chat.setup_complete)
             return db_chat.setup_complete
         else:
-            logger.info(f"Chat with id {chat.id} not found in database.")
+            logger.info("Chat with id %s not found in database.", chat.id)
             return False
 
 
 def add_chat_admins(
     chat: atypes.Chat, admins: list[atypes.ResultChatMemberUnion]
 ) -> None:
+    """Make the chat's admins match Telegram's administrator list.
+
+    Works on sets in one transaction: users are upserted in bulk, new admins
+    stop being members and admins missing from the list become members.
+    """
+    names = {
+        admin.user.id: admin.user.username if admin.user.username else ""
+        for admin in admins
+        if not admin.user.is_bot
+    }
+    admin_table = db.ChatAdmin.__table__
+    member_table = db.ChatMember.__table__
     with db.Session(db.engine) as session:
         db_chat = session.get(db.Chat, chat.id)
         if not db_chat:
-            logger.info(f"Chat with id {chat.id} not found in database.")
+            logger.info("Chat with id %s not found in database.", chat.id)
             return
-        for admin in admins:
-            if not admin.user.is_bot:
-                db_user = session.get(db.User, admin.user.id)
-                if not db_user:
-                    db_user = db.User(
-                        id=admin.user.id,
-                        user_name=admin.user.username if admin.user.username else "",
-                    )
-                    session.add(db_user)
-                    logger.info(f"Added new user: @{db_user.user_name}")
-                if db_user not in db_chat.admins:
-                    db_chat.admins.append(db_user)
-                    logger.info(
-                        f"Added admin '@{db_user.user_name}' to chat '@{db_chat.chat_name}'"
-                    )
-                if db_user in db_chat.members:
-                    db_chat.members.remove(db_user)
-                    logger.info(
-                        f"Removed user '@{db_user.user_name}' from members of chat '@{db_chat.chat_name}' as now he is admin"
-                    )
+        chat_name = db_chat.chat_name
+        connection = session.connection()
+        current = set(
+            connection.execute(
+                db.select(admin_table.c.user_id).where(admin_table.c.chat_id == chat.id)
+            ).scalars()
+        )
+        promoted = sorted(names.keys() - current)
+        demoted = sorted(current - names.keys())
+        db.insert_or_ignore_many(
+            session,
+            db.User,
+            [{"id": user_id, "user_name": name} for user_id, name in names.items()],
+        )
+        db.insert_or_ignore_many(
+            session,
+            db.ChatAdmin,
+            [{"user_id": user_id, "chat_id": chat.id} for user_id in promoted],
+        )
+        if names:
+            connection.execute(
+                db.delete(member_table).where(
+                    member_table.c.chat_id == chat.id,
+                    member_table.c.user_id.in_(list(names)),
+                )
+            )
+        if demoted:
+            connection.execute(
+                db.delete(admin_table).where(
+                    admin_table.c.chat_id == chat.id,
+                    admin_table.c.user_id.in_(demoted),
+                )
+            )
+            db.insert_or_ignore_many(
+                session,
+                db.ChatMember,
+                [{"user_id": user_id, "chat_id": chat.id} for user_id in demoted],
+            )
+        version = _bump_version(session, chat.id)
         session.commit()
+    logger.info(
+        "Synced admins of chat '@%s': %d admins, promoted %s, demoted %s",
+        chat_name,
+        len(names),
+        promoted,
+        demoted,
+    )
+    invalidate_chat(chat.id, version)
 
 
 def user_left_chat(chat_id: int, user_id: int) -> None:
     with db.Session(db.engine) as session:
         db_chat = session.get(db.Chat, chat_id)
         if not db_chat:
-            logger.info(f"Chat with id {chat_id} not found in database.")
+            logger.info("Chat with id %s not found in database.", chat_id)
             return
         db_user = session.get(db.User, user_id)
         if not db_user:
-            logger.info(f"User with id {user_id} not found in database.")
+            logger.info("User with id %s not found in database.", user_id)
             return
-        if db_user in db_chat.members:
-            db_chat.members.remove(db_user)
+        if db.ChatMember.remove(session, user_id, chat_id):
             logger.info(
-                f"Removed user '@{db_user.user_name}' from members of chat '@{db_chat.chat_name}'"
+                "Removed user '@%s' from members of chat '@%s'",
+                db_user.user_name,
+                db_chat.chat_name,
             )
-        if db_user in db_chat.admins:
-            db_chat.admins.remove(db_user)
+        if db.ChatAdmin.remove(session, user_id, chat_id):
             logger.info(
-                f"Removed user '@{db_user.user_name}' from admins of chat '@{db_chat.chat_name}' as he left the chat"
+                "Removed user '@%s' from admins of chat '@%s' as he left the chat",
+                db_user.user_name,
+                db_chat.chat_name,
             )
+        version = _bump_version(session, chat_id)
         session.commit()
+    invalidate_membership(chat_id, user_id, version)
 
 
 def user_joined_chat(chat_id: int, user: atypes.User) -> None:
     with db.Session(db.engine) as session:
         db_chat = session.get(db.Chat, chat_id)
         if not db_chat:
-            logger.info(f"Chat with id {chat_id} not found in database.")
+            logger.info("Chat with id %s not found in database.", chat_id)
             return
-        db_user = session.get(db.User, user.id)
-        if not db_user:
-            db_user = db.User(
-                id=user.id,
-                user_name=user.username if user.username else "",
-            )
-            session.add(db_user)
-            logger.info(f"Added new user: '@{db_user.user_name}' to database.")
+        if db.User.add(session, user.id, user.username if user.username else ""):
+            logger.info("Added new user: '@%s' to database.", user.username)
         else:
-            logger.info(f"User with id {user.id} already exists in database.")
-        if db_user not in db_chat.members:
-            # db_chat.members.append(db_user)
-            membership = db.ChatMember(user_id=db_user.id, chat_id=db_chat.id)
-            session.add(membership)
+            logger.info("User with id %s already exists in database.", user.id)
+        next_notify_time = None
+        if db.ChatMember.add(
+            session,
+            user.id,
+            chat_id,
+            last_trigger_time=time() if db_chat.triggers & db.Trigger.JOIN else 0.0,
+        ):
             logger.info(
-                f"Added user '@{db_user.user_name}' to members of chat '@{db_chat.chat_name}'"
+                "Added user '@%s' to members of chat '@%s'",
+                user.username,
+                db_chat.chat_name,
             )
-            if db_chat.join_triggers:
-                membership.last_trigger_time = time()
+            if db_chat.triggers & db.Trigger.JOIN:
                 logger.info(
-                    f"Chat '@{db_chat.chat_name}' has join_triggers enabled. Setting last_trigger_time for user '@{db_user.user_name}'."
+                    "Chat '@%s' has join triggers enabled. Setting last_trigger_time for user '@%s'.",
+                    db_chat.chat_name,
+                    user.username,
                 )
+                next_notify_time = _refresh_keys(session, time(), [(chat_id, user.id)])
+                session.add(
+                    db.ActivityEvent(
+                        chat_id=chat_id,
+                        user_id=user.id,
+                        content_type="join",
+                        ts=time(),
+                        inserted_at=time(),
+                    )
+                )
+        version = _bump_version(session, chat_id)
         session.commit()
+    invalidate_membership(chat_id, user.id, version)
+    _announce_next_notify_time(next_notify_time)
 
 
 def promote_user_to_admin(chat_id: int, user: atypes.User) -> None:
     with db.Session(db.engine) as session:
         db_chat = session.get(db.Chat, chat_id)
         if not db_chat:
-            db_chat = db.Chat(id=chat_id)
-            logger.info(f"Chat with id {chat_id} not found in database.")
+            logger.info("Chat with id %s not found in database.", chat_id)
             return
-        db_user = session.get(db.User, user.id)
-        if not db_user:
-            db_user = db.User(
-                id=user.id,
-                user_name=user.username if user.username else "",
-            )
-            session.add(db_user)
-            logger.info(f"Added new user: '@{db_user.user_name}' to database.")
+        if db.User.add(session, user.id, user.username if user.username else ""):
+            logger.info("Added new user: '@%s' to database.", user.username)
         else:
-            logger.info(f"User with id {user.id} already exists in database.")
-        if db_user not in db_chat.admins:
-            db_chat.admins.append(db_user)
+            logger.info("User with id %s already exists in database.", user.id)
+        if db.ChatAdmin.add(session, user.id, chat_id):
             logger.info(
-                f"Promoted user '@{db_user.user_name}' to admin in chat '@{db_chat.chat_name}'"
+                "Promoted user '@%s' to admin in chat '@%s'",
+                user.username,
+                db_chat.chat_name,
             )
-        if db_user in db_chat.members:
-            db_chat.members.remove(db_user)
+        if db.ChatMember.remove(session, user.id, chat_id):
             logger.info(
-                f"Removed user '@{db_user.user_name}' from members of chat '@{db_chat.chat_name}' as now he is admin"
+                "Removed user '@%s' from members of chat '@%s' as now he is admin",
+                user.username,
+                db_chat.chat_name,
             )
+        version = _bump_version(session, chat_id)
         session.commit()
+    invalidate_membership(chat_id, user.id, version)
 
 
 def demote_user_to_member(chat_id: int, user: atypes.User) -> None:
     with db.Session(db.engine) as session:
         db_chat = session.get(db.Chat, chat_id)
         if not db_chat:
-            logger.info(f"Chat with id {chat_id} not found in database.")
+            logger.info("Chat with id %s not found in database.", chat_id)
             return
-        db_user = session.get(db.User, user.id)
-        if not db_user:
-            logger.info(f"User with id {user.id} not found in database.")
+        if not session.get(db.User, user.id):
+            logger.info("User with id %s not found in database.", user.id)
             return
-        if db_user in db_chat.admins:
-            db_chat.admins.remove(db_user)
+        if db.ChatAdmin.remove(session, user.id, chat_id):
             logger.info(
-                f"Removed user '@{db_user.user_name}' from admins of chat '@{db_chat.chat_name}'"
+                "Removed user '@%s' from admins of chat '@%s'",
+                user.username,
+                db_chat.chat_name,
             )
-        if db_user not in db_chat.members:
-            db_chat.members.append(db_user)
+        if db.ChatMember.add(session, user.id, chat_id):
             logger.info(
-                f"Added user '@{db_user.user_name}' to members of chat '@{db_chat.chat_name}'"
+                "Added user '@%s' to members of chat '@%s'",
+                user.username,
+                db_chat.chat_name,
             )
+        version = _bump_version(session, chat_id)
         session.commit()
+    invalidate_membership(chat_id, user.id, version)
 
 
-def got_message(message: atypes.Message) -> None:
+class ChatSettings(NamedTuple):
+    chat_name: str
+    # Trigger bits of the events that count as activity in this chat.
+    triggers: db.Trigger
+
+
+# Message content type -> the trigger bit that makes it count as activity.
+# Content types missing here never trigger.
+CONTENT_TYPE_TRIGGERS: dict[str, db.Trigger] = {
+    atypes.ContentType.TEXT: db.Trigger.TEXT,
+    atypes.ContentType.PHOTO: db.Trigger.PHOTO,
+    atypes.ContentType.VIDEO: db.Trigger.VIDEO,
+    atypes.ContentType.VOICE: db.Trigger.VOICE,
+    atypes.ContentType.VIDEO_NOTE: db.Trigger.VIDEO_NOTE,
+}
+
+
+MEMBER = "member"
+ADMIN = "admin"
+
+# chat_id -> ChatSettings, or None for chats that are not in the database.
+chat_cache: TTLCache[int, ChatSettings | None] = TTLCache(
+    config.CACHE_SIZE, config.CACHE_TTL
+)
+# Ids of users known to exist in the database.
+user_cache: TTLCache[int, bool] = TTLCache(config.CACHE_SIZE, config.CACHE_TTL)
+# (chat_id, user_id) -> MEMBER, ADMIN or None when the user is neither.
+membership_cache: TTLCache[tuple[int, int], str | None] = TTLCache(
+    config.CACHE_SIZE, config.CACHE_TTL
+)
+
+# With config.MEMBER_STORE all memberships live in member_store instead of
+# membership_cache. It is loaded by db_init and again whenever the caches are
+# cleared or this worker gains shards, since other workers may have added
+# memberships to them meanwhile. Chats written by other processes are
+# re-read on their own (see sync_chat_versions).
+if config.MEMBER_STORE:
+    import member_store
+
+    store: "member_store.MemberStore | None" = member_store.MemberStore()
+    _STORE_STATES = {member_store.MEMBER: MEMBER, member_store.ADMIN: ADMIN}
+else:
+    store = None
+# Shards whose rows in the store are current: all of them right after a
+# load, then only those this worker kept holding. None before the first load.
+_store_shards: frozenset[int] | None = None
+
+
+def _all_shards(shards: Collection[int] | None) -> frozenset[int]:
+    return frozenset(range(config.SHARD_COUNT) if shards is None else shards)
+
+
+# Rows read from the database per chunk, so that loading the store never
+# holds more than a chunk of them as Python objects.
+_STORE_CHUNK = 50_000
+
+
+def _store_rows(connection, *criteria: Callable) -> "Generator[np.ndarray, None, None]":
+    # Memberships and admin rows as chunks of member_store rows; each
+    # criterion is called with the table to filter.
+    member = db.ChatMember.__table__
+    admin = db.ChatAdmin.__table__
+    # Admins first, so that members win for users who are both, as in
+    # _membership.
+    statements = (
+        db.select(
+            admin.c.chat_id,
+            admin.c.user_id,
+            db.literal(0.0),
+            db.literal(0.0),
+            db.literal(member_store.ADMIN),
+            admin.c.is_muted,
+        ).where(*(criterion(admin) for criterion in criteria)),
+        db.select(
+            member.c.chat_id,
+            member.c.user_id,
+            member.c.last_trigger_time,
+            member.c.last_notify_time,
+            db.literal(member_store.MEMBER),
+            member.c.is_muted,
+        ).where(*(criterion(member) for criterion in criteria)),
+    )
+    for statement in statements:
+        result = connection.execute(statement.execution_options(yield_per=_STORE_CHUNK))
+        for partition in result.partitions():
+            yield member_store.rows(partition)
+
+
+def _load_store() -> None:
+    global _store_shards
+    assert store is not None
+    # Should loading fail half way, the next scan loads again.
+    _store_shards = frozenset()
+    store.clear()
     with db.Session(db.engine) as session:
-        db_chat = session.get(db.Chat, message.chat.id)
-        if not db_chat:
-            logger.info(f"Chat with id {message.chat.id} not found in database.")
+        for rows in _store_rows(session.connection()):
+            store.upsert(rows)
+    _store_shards = _all_shards(None)
+    logger.info(
+        "Loaded %d memberships into the member store (%d bytes).",
+        len(store),
+        store.nbytes,
+    )
+
+
+def _refresh_store(chat_id: int, user_id: int | None = None) -> None:
+    # Re-read a chat's memberships, or one of them, after a write.
+    if store is None or _store_shards is None:
+        return
+    criteria = [lambda table: table.c.chat_id == chat_id]
+    if user_id is not None:
+        criteria.append(lambda table: table.c.user_id == user_id)
+    store.forget(chat_id, user_id)
+    with db.Session(db.engine) as session:
+        for rows in _store_rows(session.connection(), *criteria):
+            store.upsert(rows)
+
+
+def _refresh_store_chats(chat_ids: list[int]) -> None:
+    # _refresh_store for many chats, a chunk of them per query.
+    if store is None or _store_shards is None:
+        return
+    store.forget_chats(chat_ids)
+    with db.Session(db.engine) as session:
+        for start in range(0, len(chat_ids), 500):
+            chunk = chat_ids[start : start + 500]
+            for rows in _store_rows(
+                session.connection(), lambda table: table.c.chat_id.in_(chunk)
+            ):
+                store.upsert(rows)
+
+
+def _refresh_store_keys(session: db.Session, keys: list[tuple[int, int]]) -> None:
+    assert store is not None
+    for start in range(0, len(keys), 500):
+        chunk = keys[start : start + 500]
+        for rows in _store_rows(
+            session.connection(),
+            lambda table: db.tuple_(table.c.chat_id, table.c.user_id).in_(chunk),
+        ):
+            store.upsert(rows)
+
+
+def _cached_membership(chat_id: int, user_id: int) -> str | None:
+    # MEMBER, ADMIN, None or MISSING, from the store or membership_cache.
+    if store is None:
+        return membership_cache.get((chat_id, user_id))
+    return _STORE_STATES.get(store.state(chat_id, user_id), MISSING)
+
+
+def _chat_settings(db_chat: db.Chat) -> ChatSettings:
+    return ChatSettings(db_chat.chat_name, db.Trigger(db_chat.triggers))
+
+
+def _membership(
+    session: db.Session, chat_id: int, user_id: int
+) -> "db.ChatMember | db.ChatAdmin | None":
+    return session.get(db.ChatMember, (user_id, chat_id)) or session.get(
+        db.ChatAdmin, (user_id, chat_id)
+    )
+
+
+# Called with the id of a chat whose settings, admins or members were
+# written, so that views of it cached elsewhere (read_model.py) are dropped.
+chat_changed_listeners: list[Callable[[int], None]] = []
+
+
+def _announce_chat_changed(chat_id: int) -> None:
+    for listener in chat_changed_listeners:
+        listener(chat_id)
+
+
+# Every write that invalidates the caches above also bumps the version of
+# its chat (db.Chat.version), in the same transaction. _chat_versions holds
+# the version of every chat as this process last saw it, so comparing it
+# with the database tells which chats another process (the admin panel,
+# another worker) wrote meanwhile. None before the first look.
+_state_lock = Lock()
+_chat_versions: dict[int, int] | None = None
+
+
+def _bump_version(session: db.Session, chat_id: int) -> int | None:
+    # Within the writing transaction; the chat's new version, None if it is
+    # gone.
+    chat = db.Chat.__table__
+    connection = session.connection()
+    connection.execute(
+        db.update(chat).where(chat.c.id == chat_id).values(version=chat.c.version + 1)
+    )
+    return connection.execute(
+        db.select(chat.c.version).where(chat.c.id == chat_id)
+    ).scalar()
+
+
+def _saw_version(chat_id: int, version: int | None, dropped: bool = False) -> None:
+    # After committing a bump to `version`: unless someone else wrote the
+    # chat since we last looked, our own write is all there is to see. When
+    # everything cached about the chat was dropped after the commit, nothing
+    # older than `version` is left either way.
+    with _state_lock:
+        if _chat_versions is None:
             return
-        if message.from_user:
-            db_user = session.get(db.User, message.from_user.id)
-            if not db_user:
-                db_user = db.User(
-                    id=message.from_user.id,
-                    user_name=(
-                        message.from_user.username if message.from_user.username else ""
-                    ),
+        if version is None:
+            _chat_versions.pop(chat_id, None)
+        elif dropped or _chat_versions.get(chat_id) == version - 1:
+            _chat_versions[chat_id] = version
+
+
+def get_chat_versions() -> dict[int, int]:
+    chat = db.Chat.__table__
+    with db.Session(db.engine) as session:
+        return dict(
+            session.connection().execute(db.select(chat.c.id, chat.c.version)).all()
+        )
+
+
+def get_existing_users(user_ids: list[int]) -> set[int]:
+    """Return those of `user_ids` that are in the database."""
+    user = db.User.__table__
+    existing = set()
+    with db.Session(db.engine) as session:
+        for start in range(0, len(user_ids), 500):
+            existing.update(
+                session.connection()
+                .scalars(
+                    db.select(user.c.id).where(
+                        user.c.id.in_(user_ids[start : start + 500])
+                    )
                 )
-                session.add(db_user)
-                logger.info(f"Added new user: '@{db_user.user_name}' to database.")
-            else:
+                .all()
+            )
+    return existing
+
+
+def sync_chat_versions() -> dict[int, int]:
+    """Drop what is cached about the chats other processes wrote since the
+    last call.
+
+    Returns the current version of every chat; what is cached about a chat
+    afterwards is at least as new as that version.
+    """
+    global _chat_versions
+    versions = get_chat_versions()
+    with _state_lock:
+        seen = _chat_versions
+        _chat_versions = dict(versions)
+    if seen is None:
+        clear_caches()
+    else:
+        changed = [
+            chat_id
+            for chat_id in versions.keys() | seen.keys()
+            if versions.get(chat_id) != seen.get(chat_id)
+        ]
+        if changed:
+            logger.info("%d chats were changed by other processes.", len(changed))
+            _drop_chats(changed)
+    return versions
+
+
+def _drop_chats(chat_ids: Collection[int]) -> None:
+    chat_ids = set(chat_ids)
+    for chat_id in chat_ids:
+        chat_cache.pop(chat_id)
+    membership_cache.pop_where(lambda key: key[0] in chat_ids)
+    _refresh_store_chats(sorted(chat_ids))
+    for chat_id in chat_ids:
+        _announce_chat_changed(chat_id)
+
+
+def clear_caches() -> None:
+    chat_cache.clear()
+    user_cache.clear()
+    membership_cache.clear()
+    if _store_shards is not None:
+        _load_store()
+
+
+def invalidate_chat(chat_id: int, version: int | None) -> None:
+    # After committing a write of the chat that bumped it to `version`.
+    chat_cache.pop(chat_id)
+    membership_cache.pop_where(lambda key: key[0] == chat_id)
+    _refresh_store(chat_id)
+    _saw_version(chat_id, version, dropped=True)
+    _announce_chat_changed(chat_id)
+
+
+def invalidate_membership(chat_id: int, user_id: int, version: int | None) -> None:
+    membership_cache.pop((chat_id, user_id))
+    _refresh_store(chat_id, user_id)
+    _saw_version(chat_id, version)
+    _announce_chat_changed(chat_id)
+
+
+def ignores_message(message: atypes.Message) -> bool:
+    # Whether the message can be dropped without going to the database: its
+    # content type never triggers, or the cached chat does not track it.
+    trigger = CONTENT_TYPE_TRIGGERS.get(message.content_type)
+    if trigger is None:
+        return True
+    settings = chat_cache.get(message.chat.id)
+    return settings is not MISSING and (
+        settings is None or not settings.triggers & trigger
+    )
+
+
+def got_message(message: atypes.Message) -> None:
+    if not message.from_user:
+        logger.info("Message has no from_user field.")
+        return
+    chat_id = message.chat.id
+    user_id = message.from_user.id
+    settings = chat_cache.get(chat_id)
+    if settings is MISSING:
+        settings = _load_chat_settings(chat_id)
+    if settings is None:
+        logger.info("Chat with id %s not found in database.", chat_id)
+        return
+    # Untracked content types are dropped before the user and the membership
+    # are looked at.
+    trigger = CONTENT_TYPE_TRIGGERS.get(message.content_type, db.Trigger(0))
+    if not settings.triggers & trigger:
+        logger.info(
+            "Message of type %s does not trigger notifications for chat '@%s'.",
+            message.content_type,
+            settings.chat_name,
+        )
+        return
+    state = _cached_membership(chat_id, user_id)
+    if state is MISSING:
+        state = _load_membership(message, settings)
+    if state != MEMBER:
+        logger.info(
+            "User with id %s is not a member of chat '@%s'. Nothing to trigger.",
+            user_id,
+            settings.chat_name,
+        )
+        return
+    logger.info(
+        "Message %s triggers are enabled for chat '@%s'. Updating last_trigger_time for user with id %s.",
+        message.content_type,
+        settings.chat_name,
+        user_id,
+    )
+    trigger_time = time()
+    trigger_buffer.add(chat_id, user_id, message.content_type, trigger_time)
+    if store is not None:
+        store.touch(chat_id, user_id, trigger_time)
+
+
+def _load_chat_settings(chat_id: int) -> ChatSettings | None:
+    with db.Session(db.engine) as session:
+        db_chat = session.get(db.Chat, chat_id)
+        settings = _chat_settings(db_chat) if db_chat else None
+    chat_cache.set(chat_id, settings)
+    return settings
+
+
+def _load_membership(message: atypes.Message, settings: ChatSettings) -> str:
+    assert message.from_user
+    chat_id = message.chat.id
+    user = message.from_user
+    with db.Session(db.engine) as session:
+        if not user_cache.get(user.id, False):
+            if db.User.add(session, user.id, user.username if user.username else ""):
+                logger.info("Added new user: '@%s' to database.", user.username)
+        link = _membership(session, chat_id, user.id)
+        if link is None:
+            if db.ChatMember.add(session, user.id, chat_id):
                 logger.info(
-                    f"User with id {message.from_user.id} already exists in database."
+                    "Added user '@%s' to members of chat '@%s'",
+                    user.username,
+                    settings.chat_name,
                 )
+            link = db.ChatMember(user_id=user.id, chat_id=chat_id)
+        state = ADMIN if isinstance(link, db.ChatAdmin) else MEMBER
+        if store is not None:
+            row = _store_row(link)
+        session.commit()
+    user_cache.set(user.id, True)
+    if store is None:
+        membership_cache.set((chat_id, user.id), state)
+    else:
+        store.put(*row)
+    return state
+
+
+def _store_row(link: "db.ChatMember | db.ChatAdmin") -> tuple:
+    # A membership _load_membership found or added, as MemberStore.put
+    # arguments.
+    if isinstance(link, db.ChatMember):
+        values = (link.last_trigger_time, link.last_notify_time, member_store.MEMBER)
+    else:
+        values = (0.0, 0.0, member_store.ADMIN)
+    return (link.chat_id, link.user_id, *values, link.is_muted)
+
+
+# Called with the earliest next_notify_time written by a handler, so that the
+# notifier can wake up sooner than it planned to.
+next_notify_listeners: list[Callable[[float], None]] = []
+
+
+def _announce_next_notify_time(next_notify_time: float | None) -> None:
+    if next_notify_time is not None:
+        for listener in next_notify_listeners:
+            listener(next_notify_time)
+
+
+def _next_notify_time(current_time: float, last_notify_time: float | None = None):
+    # SQL expression for ChatMember.next_notify_time: the member is due once
+    # both notify_time since the last trigger and notify_interval since the
+    # last notification have passed, unless that is past notify_max_time.
+    # Pass last_notify_time when the same UPDATE also sets that column.
+    member = db.ChatMember.__table__
+    chat = db.Chat.__table__
+    interval = db.case(
+        (chat.c.notify_interval > config.MIN_NOTIFY_INTERVAL, chat.c.notify_interval),
+        else_=config.MIN_NOTIFY_INTERVAL,
+    )
+    first = member.c.last_trigger_time + chat.c.notify_time
+    if last_notify_time is None:
+        repeat = member.c.last_notify_time + interval
+    else:
+        repeat = last_notify_time + interval
+    due = db.case((first > repeat, first), else_=repeat)
+    expires = member.c.last_trigger_time + chat.c.notify_max_time
+    return db.case(
+        (
+            db.or_(
+                member.c.is_muted,
+                chat.c.notify_time <= 0,
+                due >= expires,
+                expires <= current_time,
+            ),
+            db.null(),
+        ),
+        else_=due,
+    )
+
+
+def refresh_next_notify_time(
+    session: db.Session, current_time: float, *criteria
+) -> float | None:
+    """Recompute next_notify_time of the memberships matching `criteria`.
+
+    Returns the earliest resulting next_notify_time, if any.
+    """
+    member = db.ChatMember.__table__
+    chat = db.Chat.__table__
+    connection = session.connection()
+    connection.execute(
+        db.update(member)
+        .where(member.c.chat_id == chat.c.id, *criteria)
+        .values(next_notify_time=_next_notify_time(current_time))
+    )
+    return connection.execute(
+        db.select(db.func.min(member.c.next_notify_time)).where(*criteria)
+    ).scalar()
+
+
+def _refresh_keys(
+    session: db.Session, current_time: float, keys: list[tuple[int, int]]
+) -> float | None:
+    member = db.ChatMember.__table__
+    earliest = None
+    for start in range(0, len(keys), 500):
+        next_notify_time = refresh_next_notify_time(
+            session,
+            current_time,
+            db.tuple_(member.c.chat_id, member.c.user_id).in_(
+                keys[start : start + 500]
+            ),
+        )
+        if next_notify_time is not None and (
+            earliest is None or next_notify_time < earliest
+        ):
+            earliest = next_notify_time
+    return earliest
+
+
+def refresh_all_next_notify_times() -> None:
+    with db.Session(db.engine) as session:
+        refresh_next_notify_time(session, time())
+        session.commit()
+
+
+def get_next_notify_time(shards: Collection[int] | None = None) -> float | None:
+    with db.Session(db.engine) as session:
+        return session.exec(
+            db.select(db.func.min(db.ChatMember.next_notify_time)).where(
+                *_shard_criteria(shards)
+            )
+        ).one()
+
+
+def append_activity(events: list[Activity]) -> None:
+    # Triggers only ever insert, so busy members' rows are not rewritten on
+    # every message; compact_activity folds the log into them.
+    inserted_at = time()
+    with db.Session(db.engine) as session:
+        session.connection().execute(
+            db.ActivityEvent.__table__.insert(),
+            [
+                {
+                    "chat_id": c,
+                    "user_id": u,
+                    "content_type": t,
+                    "ts": ts,
+                    "inserted_at": inserted_at,
+                }
+                for c, u, t, ts in events
+            ],
+        )
+        session.commit()
+
+
+def _write_trigger_times(
+    session: db.Session, pending: dict[tuple[int, int], float]
+) -> float | None:
+    # A single executemany UPDATE; the last_trigger_time guard keeps older
+    # events from overwriting a newer value, so folding twice is harmless.
+    table = db.ChatMember.__table__
+    statement = (
+        db.update(table)
+        .where(
+            table.c.chat_id == db.bindparam("b_chat_id"),
+            table.c.user_id == db.bindparam("b_user_id"),
+            table.c.last_trigger_time < db.bindparam("b_trigger_time"),
+        )
+        .values(last_trigger_time=db.bindparam("b_trigger_time"))
+    )
+    session.connection().execute(
+        statement,
+        [
+            {"b_chat_id": chat_id, "b_user_id": user_id, "b_trigger_time": t}
+            for (chat_id, user_id), t in pending.items()
+        ],
+    )
+    return _refresh_keys(session, time(), list(pending))
+
+
+# Per shard, the latest trigger time folded for every member with events
+# above the shard's watermark, so the next compaction skips what it already
+# wrote.
+_folded_activity: dict[int, dict[tuple[int, int], float]] = {}
+
+
+def compact_activity(shards: Collection[int] | None = None) -> int:
+    """Fold new activity events of `shards` into the memberships.
+
+    Every shard has its own watermark: all events at or below it are
+    folded. Ids are assigned at insert but become visible at commit, so the
+    watermark only moves up to events inserted more than ACTIVITY_FOLD_LAG
+    ago, whenever they happened; newer ones are folded as they appear and
+    looked at again until the watermark passes them. Folded events older than ACTIVITY_RETENTION_DAYS are
+    trimmed. Returns the number of members whose last_trigger_time was
+    folded.
+    """
+    if shards is None:
+        shards = range(config.SHARD_COUNT)
+    names = {f"activity:{shard}": shard for shard in shards}
+    if not names:
+        return 0
+    event = db.ActivityEvent.__table__
+    checkpoint = db.Checkpoint.__table__
+    current_time = time()
+    settled = current_time - config.ACTIVITY_FOLD_LAG
+    with db.Session(db.engine) as session:
+        connection = session.connection()
+        watermarks = dict.fromkeys(names.values(), 0)
+        for name, value in connection.execute(
+            db.select(checkpoint.c.name, checkpoint.c.value).where(
+                checkpoint.c.name.in_(names)
+            )
+        ):
+            watermarks[names[name]] = value
+        # Latest event per member; events at or below a watermark that come
+        # along are folded again, which changes nothing.
+        rows = connection.execute(
+            db.select(
+                event.c.chat_id,
+                event.c.user_id,
+                db.func.max(event.c.ts),
+                db.func.max(event.c.id),
+                db.func.max(db.case((event.c.inserted_at < settled, event.c.id))),
+            )
+            .where(
+                event.c.id > min(watermarks.values()),
+                *_shard_criteria(shards, event.c.chat_id),
+            )
+            .group_by(event.c.chat_id, event.c.user_id)
+        )
+        pending = {}
+        folded = {shard: {} for shard in watermarks}
+        settled_ids = dict(watermarks)
+        for chat_id, user_id, trigger_time, last_id, settled_id in rows:
+            shard = shard_of(chat_id)
+            if last_id <= watermarks[shard]:
+                continue
+            key = (chat_id, user_id)
+            folded[shard][key] = trigger_time
+            if trigger_time > _folded_activity.get(shard, {}).get(key, 0.0):
+                pending[key] = trigger_time
+            if settled_id is not None:
+                settled_ids[shard] = max(settled_ids[shard], settled_id)
+        next_notify_time = _write_trigger_times(session, pending) if pending else None
+        advanced = [
+            {"b_name": name, "b_value": settled_ids[shard]}
+            for name, shard in names.items()
+            if settled_ids[shard] > watermarks[shard]
+        ]
+        if advanced:
+            db.insert_or_ignore_many(
+                session,
+                db.Checkpoint,
+                [{"name": row["b_name"], "value": 0} for row in advanced],
+            )
+            connection.execute(
+                db.update(checkpoint)
+                .where(checkpoint.c.name == db.bindparam("b_name"))
+                .values(value=db.bindparam("b_value")),
+                advanced,
+            )
+        connection.execute(
+            db.delete(event).where(
+                event.c.ts < current_time - config.ACTIVITY_RETENTION_DAYS * 86400,
+                event.c.id <= min(settled_ids.values()),
+                *_shard_criteria(shards, event.c.chat_id),
+            )
+        )
+        session.commit()
+    _folded_activity.update(folded)
+    _announce_next_notify_time(next_notify_time)
+    return len(pending)
+
+
+trigger_buffer = TriggerBuffer(
+    append_activity, config.TRIGGER_FLUSH_SIZE, config.TRIGGER_FLUSH_INTERVAL
+)
+
+
+class SleepyMember(NamedTuple):
+    chat_id: int
+    chat_name: str
+    user_id: int
+    user_name: str
+    # Unmuted admins of the chat as (user_id, user_name).
+    admins: list[tuple[int, str]]
+
+
+def _shard_criteria(shards: Collection[int] | None, chat_id=None) -> list:
+    # Rows (memberships by default) in the given chat shards (see
+    # sharding.py); all of them when shards is None.
+    if shards is None or set(range(config.SHARD_COUNT)) <= set(shards):
+        return []
+    if chat_id is None:
+        chat_id = db.ChatMember.__table__.c.chat_id
+    return [(db.func.abs(chat_id) % config.SHARD_COUNT).in_(sorted(shards))]
+
+
+def _due_criteria(current_time: float, shards: Collection[int] | None = None) -> list:
+    # Memberships that need a notification at current_time. Must be used
+    # with ChatMember joined to (or updated from) Chat.
+    member = db.ChatMember.__table__
+    chat = db.Chat.__table__
+    return [
+        *_shard_criteria(shards),
+        member.c.chat_id == chat.c.id,
+        member.c.next_notify_time <= current_time,
+        member.c.is_muted == False,
+        member.c.last_trigger_time < current_time - chat.c.notify_time,
+        member.c.last_trigger_time > current_time - chat.c.notify_max_time,
+        member.c.last_notify_time < current_time - chat.c.notify_interval,
+    ]
+
+
+def get_sleepy_members(
+    current_time: float, shards: Collection[int] | None = None
+) -> list[SleepyMember]:
+    # Make buffered triggers visible before looking for sleepy members.
+    trigger_buffer.flush()
+    compact_activity(shards)
+    keys = _store_due_keys(current_time, shards)
+    # One query for the due memberships with their users and chats, one for
+    # the admins of those chats, whatever the number of members. With the
+    # member store only the keys its scan found due are looked at, a chunk
+    # at a time.
+    statement = (
+        db.select(db.ChatMember)
+        .where(*_due_criteria(current_time, shards))
+        .options(
+            db.joinedload(db.ChatMember.user),
+            db.joinedload(db.ChatMember.chat)
+            .selectinload(db.Chat.admin_memberships)
+            .joinedload(db.ChatAdmin.user),
+        )
+    )
+    sleepy_members = []
+    with db.Session(db.engine) as session:
+        chat_admins: dict[int, list[tuple[int, str]]] = {}
+        if keys is None:
+            memberships = session.exec(statement).unique()
         else:
-            logger.info("Message has no from_user field.")
-            return
-        if db_user not in db_chat.members and db_user not in db_chat.admins:
-            db_chat.members.append(db_user)
-            logger.info(
-                f"Added user '@{db_user.user_name}' to members of chat '@{db_chat.chat_name}'"
+            key = db.tuple_(db.ChatMember.chat_id, db.ChatMember.user_id)
+            memberships = (
+                membership
+                for start in range(0, len(keys), 500)
+                for membership in session.exec(
+                    statement.where(key.in_(keys[start : start + 500]))
+                ).unique()
             )
-        membership = db.ChatMember.get(session, db_user.id, db_chat.id)
-        if membership:
-            if (
-                message.content_type == atypes.ContentType.TEXT
-                and db_chat.text_triggers
-            ):
-                logger.info(
-                    f"Message text triggers are enabled for chat '@{db_chat.chat_name}'. Updating last_trigger_time for '@{db_user.user_name}'."
-                )
-                membership.last_trigger_time = time()
-            elif (
-                message.content_type == atypes.ContentType.PHOTO
-                and db_chat.photo_triggers
-            ):
-                logger.info(
-                    f"Message photo triggers are enabled for chat '@{db_chat.chat_name}'. Updating last_trigger_time for '@{db_user.user_name}'."
-                )
-                membership.last_trigger_time = time()
-            elif (
-                message.content_type == atypes.ContentType.VIDEO
-                and db_chat.video_triggers
-            ):
-                logger.info(
-                    f"Message video triggers are enabled for chat '@{db_chat.chat_name}'. Updating last_trigger_time for '@{db_user.user_name}'."
-                )
-                membership.last_trigger_time = time()
-            elif (
-                message.content_type == atypes.ContentType.VOICE
-                and db_chat.voice_triggers
-            ):
-                logger.info(
-                    f"Message voice triggers are enabled for chat '@{db_chat.chat_name}'. Updating last_trigger_time for '@{db_user.user_name}'."
-                )
-                membership.last_trigger_time = time()
-            elif (
-                message.content_type == atypes.ContentType.VIDEO_NOTE
-                and db_chat.video_note_triggers
-            ):
-                logger.info(
-                    f"Message video_note triggers are enabled for chat '@{db_chat.chat_name}'. Updating last_trigger_time for '@{db_user.user_name}'."
+        for membership in memberships:
+            chat = membership.chat
+            if chat.id not in chat_admins:
+                chat_admins[chat.id] = [
+                    (admin_membership.user.id, admin_membership.user.user_name)
+                    for admin_membership in chat.admin_memberships
+                    if not admin_membership.is_muted
+                ]
+            sleepy_members.append(
+                SleepyMember(
+                    chat.id,
+                    chat.chat_name,
+                    membership.user_id,
+                    membership.user.user_name,
+                    chat_admins[chat.id],
                 )
-                membership.last_trigger_time = time()
-            else:
-                logger.info(
-                    f"Message of type {message.content_type} does not trigger notifications for chat '@{db_chat.chat_name}'."
-                )
-        else:
-            logger.info(
-                f"User '@{db_user.user_name}' is not a member of chat '@{db_chat.chat_name}'. Nothing to trigger."
             )
+        # Due rows that turned out not to need a notification (expired, muted,
+        # settings changed) are moved on so they stop showing up.
+        refresh_next_notify_time(
+            session,
+            current_time,
+            db.ChatMember.next_notify_time <= current_time,
+            *_shard_criteria(shards),
+        )
+        if keys is not None:
+            # The store only lags behind the database (see _store_due_keys),
+            # so the keys the database turned down are re-read to catch up.
+            found = {(member.chat_id, member.user_id) for member in sleepy_members}
+            _refresh_store_keys(session, [key for key in keys if key not in found])
         session.commit()
+    return sleepy_members
 
 
-def get_chats_to_notify(session: db.Session) -> list[db.Chat]:
-    chats = session.exec(db.select(db.Chat).where(db.Chat.notify_time > 0.0)).all()
-    return list(chats)
+def _chat_notify_settings(session: db.Session) -> "np.ndarray":
+    chat = db.Chat.__table__
+    return member_store.chats(
+        session.connection().execute(
+            db.select(
+                chat.c.id,
+                chat.c.notify_time,
+                chat.c.notify_max_time,
+                chat.c.notify_interval,
+            ).where(chat.c.notify_time > 0)
+        )
+    )
 
 
-def update_member_last_notify_time(
-    session: db.Session, member_id: int, chat_id: int
-) -> None:
-    membership = db.ChatMember.get(session, member_id, chat_id)
+def _store_due_keys(
+    current_time: float, shards: Collection[int] | None
+) -> list[tuple[int, int]] | None:
+    # Memberships the store finds due, None without a store. Its rows are
+    # never ahead of the database (triggers reach both, foreign writes
+    # refresh their chats), so this is a superset of the due memberships of the shards.
+    global _store_shards
+    if store is None:
+        return None
+    # Refreshes the chats other processes wrote.
+    sync_chat_versions()
+    if _store_shards is None or not _all_shards(shards) <= _store_shards:
+        _load_store()
+    _store_shards &= _all_shards(shards)
     with db.Session(db.engine) as session:
-        if membership:
-            membership.last_notify_time = time()
-            session.commit()
+        chat_settings = _chat_notify_settings(session)
+    return store.keys(store.due(current_time, chat_settings, shards))
+
+
+def set_last_notify_time(keys: list[tuple[int, int]], notify_time: float) -> None:
+    """Mark the memberships `keys`, as (chat_id, user_id), as notified.
+
+    Sets last_notify_time and the new next_notify_time with one UPDATE per
+    chunk of keys.
+    """
+    member = db.ChatMember.__table__
+    chat = db.Chat.__table__
+    key = db.tuple_(member.c.chat_id, member.c.user_id)
+    with db.Session(db.engine) as session:
+        for start in range(0, len(keys), 500):
+            session.connection().execute(
+                db.update(member)
+                .where(
+                    member.c.chat_id == chat.c.id, key.in_(keys[start : start + 500])
+                )
+                .values(
+                    last_notify_time=notify_time,
+                    next_notify_time=_next_notify_time(notify_time, notify_time),
+                )
+            )
+        session.commit()
+    # Only the members actually notified, so the store never runs ahead of
+    # the database.
+    if store is not None:
+        store.notified(keys, notify_time)
 
 
 @contextmanager
@@ -355,20 +1132,19 @@ def get_session() -> Generator[db.Session, None, None]:
 
 
 def setup_test_chat(chat_id: int):
-    logger.info(f"Setting up test chat with id {chat_id} in database.")
+    logger.info("Setting up test chat with id %s in database.", chat_id)
     with db.Session(db.engine) as session:
         chat = session.get(db.Chat, chat_id)
         if chat:
             chat.setup_complete = True
-            chat.join_triggers = True
-            chat.text_triggers = True
+            chat.triggers = db.Trigger.JOIN | db.Trigger.TEXT
             chat.notify_interval = 10
             chat.notify_time = 60
             chat.notify_max_time = 600
             session.commit()
-            logger.info(f"Chat with id {chat_id} marked as setup complete.")
+            logger.info("Chat with id %s marked as setup complete.", chat_id)
         else:
-            logger.info(f"Chat with id {chat_id} not found in database.")
+            logger.info("Chat with id %s not found in database.", chat_id)
 
 
 def get_all_users() -> list[db.User]:
@@ -377,131 +1153,144 @@ def get_all_users() -> list[db.User]:
         return list(users)
 
 
-def get_chats_by_admin(admin_id: int) -> list[db.Chat]:
-    with db.Session(db.engine) as session:
-        admin = session.get(db.User, admin_id)
-        if not admin:
-            logger.info(f"Admin with id {admin_id} not found in database.")
-            return []
-        return admin.admin_in
-
-
-def get_chat(chat_id: int) -> db.Chat | None:
-    with db.Session(db.engine) as session:
-        chat = session.get(db.Chat, chat_id)
-        return chat
-
-
-def save_chat_settings(chat: db.Chat) -> bool:
+def save_chat_settings(chat: "db.Chat | ChatView") -> bool:
     with db.Session(db.engine) as session:
         try:
             db_chat = session.get(db.Chat, chat.id)
             if not db_chat:
-                logger.info(f"Chat with id {chat.id} not found in database.")
+                logger.info("Chat with id %s not found in database.", chat.id)
                 return False
-            db_chat.text_triggers = chat.text_triggers
-            db_chat.photo_triggers = chat.photo_triggers
-            db_chat.video_triggers = chat.video_triggers
-            db_chat.voice_triggers = chat.voice_triggers
-            db_chat.video_note_triggers = chat.video_note_triggers
-            db_chat.join_triggers = chat.join_triggers
+            db_chat.triggers = int(chat.triggers)
             db_chat.notify_time = chat.notify_time
             db_chat.notify_max_time = chat.notify_max_time
             db_chat.notify_interval = chat.notify_interval
             db_chat.setup_complete = True
+            session.flush()
+            next_notify_time = refresh_next_notify_time(
+                session, time(), db.ChatMember.chat_id == chat.id
+            )
+            version = _bump_version(session, chat.id)
             session.commit()
+            chat_cache.pop(chat.id)
         except:
             return False
-        return True
+    _saw_version(chat.id, version)
+    _announce_chat_changed(chat.id)
+    _announce_next_notify_time(next_notify_time)
+    return True
 
 
-def get_chat_admins(chat_id: int):
-    with db.Session(db.engine) as session:
-        chat = session.get(db.Chat, chat_id)
-        if not chat:
-            logger.info(f"Chat with id {chat_id} not found in database.")
-            return []
-        return zip(chat.admins, chat.admin_memberships)
+class SaveResult(NamedTuple):
+    updated: int
+    # (user id as submitted, reason) for every row that was not saved.
+    errors: list[tuple[object, str]]
 
+    @property
+    def ok(self) -> bool:
+        return not self.errors
 
-def save_admin_settings(settings: list, chat_id: int) -> bool:
-    with db.Session(db.engine) as session:
-        for row in settings:
-            try:
-                admin_id = row["Admin ID"]
-                admin = session.get(db.User, admin_id)
-                if not admin:
-                    logger.info(f"Admin with id {admin_id} not found in database.")
-                    return False
-                membership = db.ChatAdmin.get(session, admin_id, chat_id)
-                if not membership:
-                    logger.info(
-                        f"Membership for admin id {admin_id} in chat id {chat_id} not found in database."
+
+def _save_mute_flags(
+    model: "type[db.ChatAdmin] | type[db.ChatMember]",
+    settings: list,
+    id_column: str,
+    chat_id: int,
+) -> tuple[SaveResult, float | None, int | None]:
+    # Applies the "Is Muted" column of the panel's data editor rows. Only
+    # rows that differ from the database are written, with one UPDATE per
+    # chunk of ids; rows that cannot be saved are reported, the rest is
+    # saved anyway.
+    errors: list[tuple[object, str]] = []
+    wanted: dict[int, bool] = {}
+    for row in settings:
+        try:
+            wanted[int(row[id_column])] = bool(row["Is Muted"])
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append(
+                (
+                    row.get(id_column) if isinstance(row, dict) else None,
+                    f"invalid row: {e!r}",
+                )
+            )
+    link = model.__table__
+    changed: dict[bool, list[int]] = {True: [], False: []}
+    next_notify_time = version = None
+    try:
+        with db.Session(db.engine) as session:
+            connection = session.connection()
+            current = dict(
+                connection.execute(
+                    db.select(link.c.user_id, link.c.is_muted).where(
+                        link.c.chat_id == chat_id
+                    )
+                ).all()
+            )
+            for user_id, is_muted in wanted.items():
+                if user_id not in current:
+                    errors.append((user_id, "not found in this chat"))
+                elif current[user_id] != is_muted:
+                    changed[is_muted].append(user_id)
+            for is_muted, user_ids in changed.items():
+                for start in range(0, len(user_ids), 500):
+                    connection.execute(
+                        db.update(link)
+                        .where(
+                            link.c.chat_id == chat_id,
+                            link.c.user_id.in_(user_ids[start : start + 500]),
+                        )
+                        .values(is_muted=is_muted)
                     )
-                    return False
-                membership.is_muted = row["Is Muted"]
-            except Exception as e:
-                logger.error(
-                    f"Error updating admin settings for chat id {chat_id}: {e}"
+            if model is db.ChatMember:
+                next_notify_time = _refresh_keys(
+                    session,
+                    time(),
+                    [(chat_id, user_id) for ids in changed.values() for user_id in ids],
                 )
-                return False
-        session.commit()
-        return True
+            if changed[True] or changed[False]:
+                version = _bump_version(session, chat_id)
+            session.commit()
+    except Exception as e:
+        logger.error("Error updating settings for chat id %s: %s", chat_id, e)
+        return SaveResult(0, [*errors, (None, f"database error: {e}")]), None, None
+    if errors:
+        logger.info(
+            "Could not save %d rows for chat id %s, e.g. %s",
+            len(errors),
+            chat_id,
+            errors[:5],
+        )
+    return (
+        SaveResult(len(changed[True]) + len(changed[False]), errors),
+        next_notify_time,
+        version,
+    )
 
 
-def get_chat_members(chat_id: int):
-    with db.Session(db.engine) as session:
-        chat = session.get(db.Chat, chat_id)
-        if not chat:
-            logger.info(f"Chat with id {chat_id} not found in database.")
-            return []
-        return zip(chat.members, chat.memberships)
+def save_admin_settings(settings: list, chat_id: int) -> SaveResult:
+    result, _, version = _save_mute_flags(db.ChatAdmin, settings, "Admin ID", chat_id)
+    if result.updated:
+        invalidate_chat(chat_id, version)
+    return result
 
 
-def save_member_settings(settings: list, chat_id: int) -> bool:
-    with db.Session(db.engine) as session:
-        for row in settings:
-            try:
-                member_id = row["Member ID"]
-                membership = db.ChatMember.get(session, member_id, chat_id)
-                if not membership:
-                    logger.info(
-                        f"Admin membership for member id {member_id} not found in database."
-                    )
-                    return False
-                membership.is_muted = row["Is Muted"]
-            except Exception as e:
-                logger.error(
-                    f"Error updating member settings for chat id {chat_id}: {e}"
-                )
-                return False
-        session.commit()
-        return True
+def save_member_settings(settings: list, chat_id: int) -> SaveResult:
+    result, next_notify_time, version = _save_mute_flags(
+        db.ChatMember, settings, "Member ID", chat_id
+    )
+    if result.updated:
+        invalidate_chat(chat_id, version)
+    _announce_next_notify_time(next_notify_time)
+    return result
 
 
 def delete_chat(chat_id: int) -> bool:
     with db.Session(db.engine) as session:
         db_chat = session.get(db.Chat, chat_id)
         if not db_chat:
-            logger.info(f"Chat with id {chat_id} not found in database.")
+            logger.info("Chat with id %s not found in database.", chat_id)
             return False
         session.delete(db_chat)
         session.commit()
-        logger.info(f"Deleted chat with id {chat_id} from database.")
+        invalidate_chat(chat_id, None)
+        logger.info("Deleted chat with id %s from database.", chat_id)
         return True
-
-
-def get_members_to_notify_by_chat(
-    session: db.Session, chat: db.Chat, current_time: float
-) -> list[db.ChatMember]:
-    memberships = session.exec(
-        db.select(db.ChatMember).where(
-            db.ChatMember.chat_id == chat.id,
-            db.ChatMember.is_muted == False,
-            (current_time - db.ChatMember.last_trigger_time) > chat.notify_time,
-            (current_time - db.ChatMember.last_trigger_time) < chat.notify_max_time,
-            (current_time - db.ChatMember.last_notify_time) > chat.notify_interval,
-        )
-    ).all()
-
-    return list(memberships)
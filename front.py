@@ -1,5 +1,10 @@
+from time import time
+
 import streamlit as st
+import analytics
 import db_handlers as dbh
+import read_model
+from database import Trigger
 import pandas as pd
 
 
@@ -17,7 +22,7 @@ with st.sidebar:
     if admin_id:
         chats = {}
         # chatids = []
-        for chat in dbh.get_chats_by_admin(int(admin_id)):
+        for chat in read_model.chats_by_admin(int(admin_id)):
             # if st.button(f"**{chat.chat_name}**\n\n{chat.id}"):
             #     st.session_state["selected_chat_id"] = chat.id
             chats[chat.id] = chat.chat_name
@@ -50,10 +55,26 @@ def chat_delete_confirmation(chat_id: int):
         st.rerun()
 
 
+def changed_rows(edited: list[dict], original: list[dict]) -> list[dict]:
+    # The data editor has a fixed number of rows, in the original order.
+    return [row for row, old in zip(edited, original) if row != old]
+
+
+def show_save_result(result: dbh.SaveResult, kind: str) -> None:
+    if result.ok:
+        st.success(f"{kind.capitalize()} settings updated successfully!")
+        return
+    if result.updated:
+        st.warning(f"Updated {result.updated} {kind}s, but some rows were not saved.")
+    else:
+        st.error(f"Failed to update {kind} settings.")
+    st.error("\n".join(f"- {user_id}: {reason}" for user_id, reason in result.errors))
+
+
 # if "selected_chat_id" in st.session_state:
 if chat_id:
     # chat_id = st.session_state["selected_chat_id"]
-    chat = dbh.get_chat(chat_id)
+    chat = read_model.chat(chat_id)
     if chat:
         st.header(f"{chat.chat_name}")
         st.text(f"Chat ID: {chat.id}")
@@ -64,30 +85,18 @@ if chat_id:
             def item_changed() -> None:
                 st.session_state["chat_settings_changed"] = True
 
-            edited_chat = chat.model_copy()
+            edited = {}
             with col1:
                 st.subheader("Trigger Settings")
-                edited_chat.text_triggers = st.toggle(
-                    "Text Triggers", value=chat.text_triggers
-                )
-                edited_chat.photo_triggers = st.toggle(
-                    "Photo Triggers", value=chat.photo_triggers
-                )
-                edited_chat.video_triggers = st.toggle(
-                    "Video Triggers", value=chat.video_triggers
-                )
-                edited_chat.voice_triggers = st.toggle(
-                    "Voice Triggers", value=chat.voice_triggers
-                )
-                edited_chat.video_note_triggers = st.toggle(
-                    "Video Note Triggers", value=chat.video_note_triggers
-                )
-                edited_chat.join_triggers = st.toggle(
-                    "Join Chat Triggers", value=chat.join_triggers
-                )
+                triggers = Trigger(0)
+                for trigger in Trigger:
+                    label = f"{trigger.name.replace('_', ' ').title()} Triggers"
+                    if st.toggle(label, value=bool(chat.triggers & trigger)):
+                        triggers |= trigger
+                edited["triggers"] = int(triggers)
             with col2:
                 st.subheader("Notification Settings")
-                edited_chat.notify_time = (
+                edited["notify_time"] = (
                     st.number_input(
                         "Notification Time (hours)",
                         value=chat.notify_time / 3600,
@@ -95,7 +104,7 @@ if chat_id:
                     )
                     * 3600
                 )
-                edited_chat.notify_max_time = (
+                edited["notify_max_time"] = (
                     st.number_input(
                         "Max Notification Time (hours)",
                         value=chat.notify_max_time / 3600,
@@ -103,7 +112,7 @@ if chat_id:
                     )
                     * 3600
                 )
-                edited_chat.notify_interval = (
+                edited["notify_interval"] = (
                     st.number_input(
                         "Notification Interval (hours)",
                         value=chat.notify_interval / 3600,
@@ -111,6 +120,7 @@ if chat_id:
                     )
                     * 3600
                 )
+            edited_chat = chat._replace(**edited)
             if not edited_chat == chat:
                 if st.button("Save Settings", icon=":material/save:"):
                     if dbh.save_chat_settings(edited_chat):
@@ -119,16 +129,72 @@ if chat_id:
                     else:
                         st.error("Failed to update settings.")
 
+        with st.container(border=True):
+            st.subheader("Member activity")
+            times = analytics.member_times(chat_id)
+            now = time()
+            idle = analytics.inactivity(times, now)
+            saved = analytics.NotifySettings(
+                chat.notify_time, chat.notify_max_time, chat.notify_interval
+            )
+            tuned = analytics.NotifySettings(
+                edited["notify_time"],
+                edited["notify_max_time"],
+                edited["notify_interval"],
+            )
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Members", len(times))
+            col2.metric("Never active", len(times) - len(idle))
+            in_window = analytics.in_window(times, now, tuned)
+            col3.metric(
+                "In notification window",
+                in_window,
+                delta=in_window - analytics.in_window(times, now, saved),
+            )
+            st.text("Time since last activity")
+            st.bar_chart(
+                pd.DataFrame({"Members": analytics.histogram(idle)}), sort=False
+            )
+            columns = st.columns(len(analytics.PERCENTILES))
+            for column, (percentile, value) in zip(
+                columns, analytics.percentiles(idle).items()
+            ):
+                column.metric(f"{percentile}th percentile", f"{value / 3600:.1f} h")
+            horizons = {
+                "Next 24 hours": analytics.DAY,
+                "Next 7 days": 7 * analytics.DAY,
+            }
+            st.text("Projected notifications if nobody becomes active")
+            st.table(
+                pd.DataFrame(
+                    {
+                        "Saved settings": [
+                            analytics.projected_notifications(
+                                times, now, saved, horizon
+                            )
+                            for horizon in horizons.values()
+                        ],
+                        "Edited settings": [
+                            analytics.projected_notifications(
+                                times, now, tuned, horizon
+                            )
+                            for horizon in horizons.values()
+                        ],
+                    },
+                    index=list(horizons),
+                )
+            )
+
     with st.container(border=True):
         st.subheader("Chat admins")
-        admins = dbh.get_chat_admins(chat_id)
+        admins = read_model.chat_admins(chat_id)
         data = []
-        for admin, admin_membership in admins:
+        for admin in admins:
             data.append(
                 {
                     "Admin Name": f"@{admin.user_name}",
-                    "Admin ID": admin.id,
-                    "Is Muted": admin_membership.is_muted,
+                    "Admin ID": admin.user_id,
+                    "Is Muted": admin.is_muted,
                 }
             )
         edited_df = st.data_editor(
@@ -138,21 +204,21 @@ if chat_id:
         )
         if not edited_df == data:
             if st.button("Save Admin Changes", icon=":material/save:"):
-                if dbh.save_admin_settings(edited_df, chat_id):
-                    st.success("Admin settings updated successfully!")
-                else:
-                    st.error("Failed to update admin settings.")
+                show_save_result(
+                    dbh.save_admin_settings(changed_rows(edited_df, data), chat_id),
+                    "admin",
+                )
 
     with st.container(border=True):
         st.subheader("Chat members")
-        members = dbh.get_chat_members(chat_id)
+        members = read_model.chat_members(chat_id)
         data = []
-        for member, member_membership in members:
+        for member in members:
             data.append(
                 {
                     "Member Name": f"@{member.user_name}",
-                    "Member ID": member.id,
-                    "Is Muted": member_membership.is_muted,
+                    "Member ID": member.user_id,
+                    "Is Muted": member.is_muted,
                 }
             )
         edited_df = st.data_editor(
@@ -162,10 +228,11 @@ if chat_id:
         )
         if not edited_df == data:
             if st.button("Save Member Changes", icon=":material/save:"):
-                if dbh.save_member_settings(edited_df, chat_id):
-                    st.success("Member settings updated successfully!")
-                else:
-                    st.error("Failed to update member settings.")
+                show_save_result(
+                    dbh.save_member_settings(changed_rows(edited_df, data), chat_id),
+                    "member",
+                )
+
     with st.expander("Danger Zone", expanded=False, icon=":material/dangerous:"):
         if st.button("Delete chat from db", type="primary", icon=":material/delete:"):
             chat_delete_confirmation(chat_id)
@@ -0,0 +1,97 @@
+import atexit
+import gzip
+import logging
+import os
+import shutil
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from time import monotonic
+
+import config
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `limit` records per message template and `interval`.
+
+    Applies to INFO and below only; warnings and errors always pass. The next
+    record of a template after a suppressed stretch tells how many were
+    dropped. Templates are per event type as long as callers use lazy
+    %-formatting instead of f-strings.
+    """
+
+    def __init__(self, limit: int, interval: float) -> None:
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self._lock = threading.Lock()
+        # (logger name, template) -> [window start, records, suppressed]
+        self._windows: dict[tuple[str, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or self.limit <= 0:
+            return True
+        key = (record.name, str(record.msg))
+        now = monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self.limit:
+                window[1] += 1
+                suppressed = 0
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.msg = f"{record.msg} (%d similar messages suppressed)"
+            record.args = (*(record.args or ()), suppressed)
+        return True
+
+
+class _RecordQueueHandler(QueueHandler):
+    # The stock prepare() formats the message on the calling thread; leave
+    # that to the listener thread. Records never leave the process.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def _gzip_rotator(source: str, dest: str) -> None:
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def setup_logging() -> QueueListener:
+    """Send the root logger's records through a queue to a rotating file.
+
+    Callers only enqueue records; a background thread formats them and
+    writes config.LOG_FILE, which is gzipped on rotation.
+    """
+    file_handler = RotatingFileHandler(
+        config.LOG_FILE,
+        maxBytes=config.LOG_MAX_BYTES,
+        backupCount=config.LOG_BACKUP_COUNT,
+        encoding="utf-8",
+    )
+    file_handler.namer = lambda name: name + ".gz"
+    file_handler.rotator = _gzip_rotator
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    queue: SimpleQueue[logging.LogRecord] = SimpleQueue()
+    queue_handler = _RecordQueueHandler(queue)
+    queue_handler.addFilter(
+        RateLimitFilter(config.LOG_RATE_LIMIT, config.LOG_RATE_INTERVAL)
+    )
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(config.LOG_LEVEL)
+
+    listener = QueueListener(queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
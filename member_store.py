@@ -0,0 +1,345 @@
+"""Columnar in-memory store of chat memberships.
+
+Enabled with SHAMEBOT_MEMBER_STORE=1 (needs numpy). Memberships are kept in
+parallel typed arrays - int64 chat and user ids, float64 trigger and notify
+times, int8 states and a packed bit array of mute flags - with an
+open-addressing hash index over (chat_id, user_id), about 50 bytes per
+membership. db_handlers uses it instead of membership_cache on the message
+hot path, and scans it to find the memberships due for a notification before
+asking the database about them. The database stays authoritative; the store
+is loaded from it in chunks and refreshed on the bot's own writes and, chat by
+chat, on those of other processes.
+"""
+
+from typing import Collection, Iterable
+
+import numpy as np
+
+import config
+
+# Membership states. NEITHER marks a row that was dropped; the index has no
+# deletions, so the row stays and may be revived.
+NEITHER = 0
+MEMBER = 1
+ADMIN = 2
+
+ROW_DTYPE = np.dtype(
+    [
+        ("chat_id", np.int64),
+        ("user_id", np.int64),
+        ("last_trigger_time", np.float64),
+        ("last_notify_time", np.float64),
+        ("state", np.int8),
+        ("is_muted", np.bool_),
+    ]
+)
+
+CHAT_DTYPE = np.dtype(
+    [
+        ("id", np.int64),
+        ("notify_time", np.float64),
+        ("notify_max_time", np.float64),
+        ("notify_interval", np.float64),
+    ]
+)
+
+# Multiplicative hashing constants; the slot is the top bits of the product.
+_K1 = 0x9E3779B97F4A7C15
+_K2 = 0xC2B2AE3D27D4EB4F
+_M64 = (1 << 64) - 1
+
+
+def rows(result: Iterable) -> np.ndarray:
+    """ROW_DTYPE array from query rows in ROW_DTYPE column order."""
+    return np.fromiter(map(tuple, result), dtype=ROW_DTYPE)
+
+
+def chats(result: Iterable) -> np.ndarray:
+    """CHAT_DTYPE array from query rows in CHAT_DTYPE column order."""
+    return np.fromiter(map(tuple, result), dtype=CHAT_DTYPE)
+
+
+class MemberStore:
+    """Memberships in typed arrays, indexed by (chat_id, user_id).
+
+    Rows are only ever appended, so a row number stays valid until clear().
+    Not thread-safe; the bot only touches it from its DB thread.
+    """
+
+    def __init__(self, capacity: int = 1024) -> None:
+        self._size = 0
+        self._capacity = 0
+        self.chat_ids = np.zeros(0, np.int64)
+        self.user_ids = np.zeros(0, np.int64)
+        self.last_trigger_times = np.zeros(0, np.float64)
+        self.last_notify_times = np.zeros(0, np.float64)
+        self.states = np.zeros(0, np.int8)
+        # Bit i of byte i // 8 is the mute flag of row i.
+        self._muted = np.zeros(0, np.uint8)
+        self._resize(capacity)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            array.nbytes
+            for array in (
+                self.chat_ids,
+                self.user_ids,
+                self.last_trigger_times,
+                self.last_notify_times,
+                self.states,
+                self._muted,
+                self._slots,
+            )
+        )
+
+    def clear(self) -> None:
+        self._size = 0
+        self._slots.fill(-1)
+
+    def _resize(self, capacity: int) -> None:
+        size = self._size
+
+        def grown(array: np.ndarray, length: int) -> np.ndarray:
+            new = np.zeros(length, array.dtype)
+            new[: min(len(array), length)] = array[:length]
+            return new
+
+        self.chat_ids = grown(self.chat_ids, capacity)
+        self.user_ids = grown(self.user_ids, capacity)
+        self.last_trigger_times = grown(self.last_trigger_times, capacity)
+        self.last_notify_times = grown(self.last_notify_times, capacity)
+        self.states = grown(self.states, capacity)
+        self._muted = grown(self._muted, (capacity + 7) // 8)
+        self._capacity = capacity
+        # At most half full, so probe sequences stay short.
+        bits = max(1, (2 * capacity - 1).bit_length())
+        self._shift = 64 - bits
+        self._slots = np.full(1 << bits, -1, np.int32)
+        self._place(np.arange(size))
+
+    # Index.
+
+    def _slot(self, chat_id: int, user_id: int) -> int:
+        mixed = (((chat_id & _M64) * _K1) ^ ((user_id & _M64) * _K2)) & _M64
+        return mixed >> self._shift
+
+    def _slots_of(self, chat_ids: np.ndarray, user_ids: np.ndarray) -> np.ndarray:
+        mixed = (chat_ids.view(np.uint64) * np.uint64(_K1)) ^ (
+            user_ids.view(np.uint64) * np.uint64(_K2)
+        )
+        return (mixed >> np.uint64(self._shift)).astype(np.int64)
+
+    def _place(self, new_rows: np.ndarray) -> None:
+        # Linear probing, all rows at once: every round each unplaced row
+        # takes its slot if that is free and no other row claims it too, or
+        # moves on to the next slot.
+        mask = len(self._slots) - 1
+        positions = self._slots_of(self.chat_ids[new_rows], self.user_ids[new_rows])
+        while new_rows.size:
+            free = np.flatnonzero(self._slots[positions] < 0)
+            claimed, first = np.unique(positions[free], return_index=True)
+            self._slots[claimed] = new_rows[free[first]]
+            placed = np.zeros(new_rows.size, np.bool_)
+            placed[free[first]] = True
+            new_rows = new_rows[~placed]
+            positions = (positions[~placed] + 1) & mask
+
+    def _probe(self, chat_id: int, user_id: int) -> tuple[int, int]:
+        # The pair's slot and row, or the free slot it would take and -1.
+        slots, chat_ids, user_ids = self._slots, self.chat_ids, self.user_ids
+        mask = len(slots) - 1
+        slot = self._slot(chat_id, user_id)
+        while True:
+            row = slots.item(slot)
+            if row < 0 or (
+                chat_ids.item(row) == chat_id and user_ids.item(row) == user_id
+            ):
+                return slot, row
+            slot = (slot + 1) & mask
+
+    def _find(self, chat_id: int, user_id: int) -> int:
+        return self._probe(chat_id, user_id)[1]
+
+    def _find_many(self, chat_ids: np.ndarray, user_ids: np.ndarray) -> np.ndarray:
+        # Row of every key, -1 for unknown keys.
+        mask = len(self._slots) - 1
+        found = np.full(len(chat_ids), -1, np.int64)
+        pending = np.arange(len(chat_ids))
+        positions = self._slots_of(chat_ids, user_ids)
+        while pending.size:
+            candidates = self._slots[positions]
+            occupied = candidates >= 0
+            match = occupied.copy()
+            match[occupied] = (
+                self.chat_ids[candidates[occupied]] == chat_ids[pending[occupied]]
+            ) & (self.user_ids[candidates[occupied]] == user_ids[pending[occupied]])
+            found[pending[match]] = candidates[match]
+            probe = occupied & ~match
+            pending = pending[probe]
+            positions = (positions[probe] + 1) & mask
+        return found
+
+    # Rows.
+
+    def state(self, chat_id: int, user_id: int) -> int | None:
+        """MEMBER or ADMIN; None when the store does not know the pair."""
+        row = self._find(chat_id, user_id)
+        if row < 0:
+            return None
+        return self.states.item(row) or None
+
+    def touch(self, chat_id: int, user_id: int, trigger_time: float) -> None:
+        row = self._find(chat_id, user_id)
+        if row >= 0 and self.last_trigger_times.item(row) < trigger_time:
+            self.last_trigger_times[row] = trigger_time
+
+    def notified(self, keys: list[tuple[int, int]], notify_time: float) -> None:
+        """Set last_notify_time of the known pairs among `keys`."""
+        if not keys:
+            return
+        pairs = np.array(keys, np.int64).reshape(-1, 2)
+        rows = self._find_many(pairs[:, 0].copy(), pairs[:, 1].copy())
+        self.last_notify_times[rows[rows >= 0]] = notify_time
+
+    def put(
+        self,
+        chat_id: int,
+        user_id: int,
+        last_trigger_time: float,
+        last_notify_time: float,
+        state: int,
+        is_muted: bool,
+    ) -> None:
+        """Write a single row; upsert() without the array overhead."""
+        slot, row = self._probe(chat_id, user_id)
+        if row < 0:
+            if self._size == self._capacity:
+                self._resize(2 * self._capacity)
+                slot, _ = self._probe(chat_id, user_id)
+            row = self._size
+            self._size += 1
+            self.chat_ids[row] = chat_id
+            self.user_ids[row] = user_id
+            self._slots[slot] = row
+        self.last_trigger_times[row] = last_trigger_time
+        self.last_notify_times[row] = last_notify_time
+        self.states[row] = state
+        if is_muted:
+            self._muted[row >> 3] |= 1 << (row & 7)
+        else:
+            self._muted[row >> 3] &= ~(1 << (row & 7)) & 0xFF
+
+    def upsert(self, new: np.ndarray) -> None:
+        """Write ROW_DTYPE rows; a later row wins over an earlier one for
+        the same pair."""
+        if new.size <= 16:
+            for row in new.tolist():
+                self.put(*row)
+            return
+        # Stable sort by pair, keeping the last row of every run.
+        new = new[np.lexsort((new["user_id"], new["chat_id"]))]
+        last = np.ones(new.size, np.bool_)
+        last[:-1] = (new["chat_id"][1:] != new["chat_id"][:-1]) | (
+            new["user_id"][1:] != new["user_id"][:-1]
+        )
+        new = new[last]
+        rows = self._find_many(new["chat_id"], new["user_id"])
+        missing = np.flatnonzero(rows < 0)
+        if missing.size:
+            if self._size + missing.size > self._capacity:
+                self._resize(max(2 * self._capacity, self._size + missing.size))
+            rows[missing] = np.arange(self._size, self._size + missing.size)
+            self.chat_ids[rows[missing]] = new["chat_id"][missing]
+            self.user_ids[rows[missing]] = new["user_id"][missing]
+            self._size += missing.size
+            self._place(rows[missing])
+        self.last_trigger_times[rows] = new["last_trigger_time"]
+        self.last_notify_times[rows] = new["last_notify_time"]
+        self.states[rows] = new["state"]
+        self._set_muted(rows, new["is_muted"])
+
+    def forget(self, chat_id: int, user_id: int | None = None) -> None:
+        """Mark the pair, or all of the chat's rows, as NEITHER."""
+        if user_id is not None:
+            row = self._find(chat_id, user_id)
+            if row >= 0:
+                self.states[row] = NEITHER
+            return
+        self.states[: self._size][self.chat_ids[: self._size] == chat_id] = NEITHER
+
+    def forget_chats(self, chat_ids: Collection[int]) -> None:
+        """Mark all rows of the chats as NEITHER."""
+        size = self._size
+        self.states[:size][np.isin(self.chat_ids[:size], list(chat_ids))] = NEITHER
+
+    def _set_muted(self, rows: np.ndarray, muted: np.ndarray) -> None:
+        bytes_, bits = rows >> 3, (rows & 7).astype(np.uint8)
+        np.bitwise_or.at(
+            self._muted, bytes_[muted], np.left_shift(1, bits[muted]).astype(np.uint8)
+        )
+        np.bitwise_and.at(
+            self._muted,
+            bytes_[~muted],
+            ~np.left_shift(1, bits[~muted]).astype(np.uint8),
+        )
+
+    def muted(self) -> np.ndarray:
+        return np.unpackbits(self._muted, count=self._size, bitorder="little").astype(
+            np.bool_
+        )
+
+    # Scans.
+
+    def due(
+        self,
+        current_time: float,
+        chat_settings: np.ndarray,
+        shards: Collection[int] | None = None,
+    ) -> np.ndarray:
+        """Rows of the members due for a notification at current_time.
+
+        The vectorized counterpart of db_handlers._due_criteria together
+        with _next_notify_time, given the chats' settings as CHAT_DTYPE.
+        """
+        size = self._size
+        if not size or not chat_settings.size:
+            return np.zeros(0, np.int64)
+        chat_ids = self.chat_ids[:size]
+        # Every row's chat settings, lined up with the rows.
+        chat_settings = np.sort(chat_settings, order="id")
+        index = np.searchsorted(chat_settings["id"], chat_ids)
+        index[index == len(chat_settings)] = 0
+        settings = chat_settings[index]
+        known = settings["id"] == chat_ids
+        notify_time = settings["notify_time"]
+        notify_max_time = settings["notify_max_time"]
+        notify_interval = settings["notify_interval"]
+        last_trigger_time = self.last_trigger_times[:size]
+        last_notify_time = self.last_notify_times[:size]
+        due_at = np.maximum(
+            last_trigger_time + notify_time,
+            last_notify_time + np.maximum(notify_interval, config.MIN_NOTIFY_INTERVAL),
+        )
+        expires = last_trigger_time + notify_max_time
+        mask = (
+            known
+            & (self.states[:size] == MEMBER)
+            & ~self.muted()
+            & (notify_time > 0)
+            & (due_at < expires)
+            & (expires > current_time)
+            & (due_at <= current_time)
+            & (last_trigger_time < current_time - notify_time)
+            & (last_trigger_time > current_time - notify_max_time)
+            & (last_notify_time < current_time - notify_interval)
+        )
+        if shards is not None:
+            mask &= np.isin(np.abs(chat_ids) % config.SHARD_COUNT, list(shards))
+        return np.flatnonzero(mask)
+
+    def keys(self, rows: np.ndarray) -> list[tuple[int, int]]:
+        return list(zip(self.chat_ids[rows].tolist(), self.user_ids[rows].tolist()))
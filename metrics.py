@@ -0,0 +1,78 @@
+import asyncio
+from time import perf_counter
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import ChatMemberUpdated, Message, TelegramObject
+from prometheus_client import Counter, Gauge, Histogram
+
+HANDLER_UPDATES = Counter(
+    "shamebot_handler_updates",
+    "Updates processed, by handler and content type.",
+    ["handler", "content_type"],
+)
+HANDLER_SECONDS = Histogram(
+    "shamebot_handler_seconds",
+    "Handler latency.",
+    ["handler"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+DB_SECONDS = Histogram(
+    "shamebot_db_seconds",
+    "Latency of database operations, including the wait for the DB executor.",
+    ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+NOTIFY_CYCLE_SECONDS = Histogram(
+    "shamebot_notify_cycle_seconds",
+    "Duration of a notifier cycle.",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300),
+)
+NOTIFICATIONS = Counter(
+    "shamebot_notifications",
+    "Notification sends by result (sent, forbidden, retried, failed).",
+    ["result"],
+)
+QUEUE_DEPTH = Gauge(
+    "shamebot_queue_depth",
+    "Items waiting in internal queues.",
+    ["queue"],
+)
+EVENT_LOOP_LAG = Gauge(
+    "shamebot_event_loop_lag_seconds",
+    "How late the last event loop lag probe woke up.",
+)
+
+
+def _content_type(event: TelegramObject) -> str:
+    if isinstance(event, Message):
+        return event.content_type
+    if isinstance(event, ChatMemberUpdated):
+        return f"chat_member_{event.new_chat_member.status}"
+    return type(event).__name__
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Counts and times every handler call of the observer it is attached to."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        HANDLER_UPDATES.labels(name, _content_type(event)).inc()
+        start = perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            HANDLER_SECONDS.labels(name).observe(perf_counter() - start)
+
+
+async def monitor_event_loop(interval: float = 0.5) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(loop.time() - start - interval, 0.0))
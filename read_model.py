@@ -0,0 +1,160 @@
+"""Cached, read-only views of the database for the admin panel.
+
+Every view is a list of plain NamedTuples loaded with a single query and kept
+in a TTL cache, so Streamlit reruns do not go to the database. Writes through
+db_handlers drop the views of the chat they touched.
+"""
+
+from typing import NamedTuple
+
+import config
+import db_handlers as dbh
+from cache import MISSING, TTLCache
+
+db = dbh.db
+
+
+class ChatRow(NamedTuple):
+    id: int
+    chat_name: str
+
+
+class ChatView(NamedTuple):
+    # Same field names as db.Chat, so it can be passed to
+    # dbh.save_chat_settings.
+    id: int
+    chat_name: str
+    triggers: int
+    notify_time: float
+    notify_max_time: float
+    notify_interval: float
+    setup_complete: bool
+
+
+class LinkRow(NamedTuple):
+    # A chat admin or member.
+    user_id: int
+    user_name: str
+    is_muted: bool
+
+
+# The panel reads through its own engine. In the bot process (back.py serves
+# /api) the views get a separate pool, so API requests on FastAPI's threadpool
+# neither wait for nor hold the bot's connections.
+engine = db.engine if db.PROFILE == "panel" else db.create_db_engine("api")
+
+# (view, id) -> rows
+_views: TTLCache[tuple[str, int], object] = TTLCache(10_000, config.PANEL_CACHE_TTL)
+
+
+def invalidate(chat_id: int) -> None:
+    # Chat lists are keyed by admin, so drop all of them.
+    _views.pop_where(lambda key: key[1] == chat_id or key[0] == "chats_by_admin")
+
+
+dbh.chat_changed_listeners.append(invalidate)
+
+
+def cached(view: str, key: int, load):
+    # `load(connection)` on a miss. Views keyed by a chat id are dropped when
+    # that chat changes.
+    rows = _views.get((view, key))
+    if rows is MISSING:
+        with db.Session(engine) as session:
+            rows = load(session.connection())
+        _views.set((view, key), rows)
+    return rows
+
+
+def chats_by_admin(admin_id: int) -> list[ChatRow]:
+    chat = db.Chat.__table__
+    admin = db.ChatAdmin.__table__
+    return cached(
+        "chats_by_admin",
+        admin_id,
+        lambda connection: [
+            ChatRow(*row)
+            for row in connection.execute(
+                db.select(chat.c.id, chat.c.chat_name)
+                .where(admin.c.chat_id == chat.c.id, admin.c.user_id == admin_id)
+                .order_by(chat.c.chat_name, chat.c.id)
+            )
+        ],
+    )
+
+
+def chat(chat_id: int) -> ChatView | None:
+    table = db.Chat.__table__
+
+    def load(connection) -> ChatView | None:
+        row = connection.execute(
+            db.select(*(table.c[field] for field in ChatView._fields)).where(
+                table.c.id == chat_id
+            )
+        ).first()
+        return ChatView(*row) if row else None
+
+    return cached("chat", chat_id, load)
+
+
+def _links(model, chat_id: int):
+    link = model.__table__
+    user = db.User.__table__
+
+    def load(connection) -> list[LinkRow]:
+        return [
+            LinkRow(*row)
+            for row in connection.execute(
+                db.select(user.c.id, user.c.user_name, link.c.is_muted)
+                .where(link.c.user_id == user.c.id, link.c.chat_id == chat_id)
+                .order_by(user.c.user_name, user.c.id)
+            )
+        ]
+
+    return load
+
+
+def _link_page(model, chat_id: int, after: int | None, limit: int):
+    # Keyset pagination: the page after user id `after`, by user id.
+    link = model.__table__
+    user = db.User.__table__
+    criteria = [link.c.user_id == user.c.id, link.c.chat_id == chat_id]
+    if after is not None:
+        criteria.append(link.c.user_id > after)
+
+    def load(connection) -> list[LinkRow]:
+        return [
+            LinkRow(*row)
+            for row in connection.execute(
+                db.select(user.c.id, user.c.user_name, link.c.is_muted)
+                .where(*criteria)
+                .order_by(link.c.user_id)
+                .limit(limit)
+            )
+        ]
+
+    return load
+
+
+def chat_admins_page(chat_id: int, after: int | None, limit: int) -> list[LinkRow]:
+    return cached(
+        f"admins:{after}:{limit}",
+        chat_id,
+        _link_page(db.ChatAdmin, chat_id, after, limit),
+    )
+
+
+def chat_members_page(chat_id: int, after: int | None, limit: int) -> list[LinkRow]:
+    return cached(
+        f"members:{after}:{limit}",
+        chat_id,
+        _link_page(db.ChatMember, chat_id, after, limit),
+    )
+
+
+def chat_admins(chat_id: int) -> list[LinkRow]:
+    return cached("admins", chat_id, _links(db.ChatAdmin, chat_id))
+
+
+def chat_members(chat_id: int) -> list[LinkRow]:
+    return cached("members", chat_id, _links(db.ChatMember, chat_id))
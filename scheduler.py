@@ -0,0 +1,34 @@
+import asyncio
+from math import inf
+from time import time
+
+
+class Wakeup:
+    """Sleep until a wall-clock time that can be moved earlier while sleeping.
+
+    Must be used from the event loop thread; other threads go through
+    `loop.call_soon_threadsafe(wakeup.request, at)`.
+    """
+
+    def __init__(self) -> None:
+        self._event = asyncio.Event()
+        self._deadline = inf
+        self._requested = inf
+
+    def request(self, at: float) -> None:
+        # Requests made while not sleeping are remembered for the next sleep.
+        self._requested = min(self._requested, at)
+        if at < self._deadline:
+            self._event.set()
+
+    async def sleep_until(self, at: float) -> None:
+        self._event.clear()
+        at = min(at, self._requested)
+        self._requested = inf
+        self._deadline = at
+        try:
+            await asyncio.wait_for(self._event.wait(), max(at - time(), 0.0))
+        except TimeoutError:
+            pass
+        finally:
+            self._deadline = inf
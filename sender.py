@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from time import monotonic
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+
+from cache import MISSING, TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second with bursts of up to `capacity`.
+
+    `slow_down()` halves the rate and pauses the bucket after a flood-wait
+    error; successful sends then raise the rate back to nominal step by step.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.nominal_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self) -> None:
+        now = monotonic()
+        if now > self._paused_until:
+            start = max(self._updated, self._paused_until)
+            self._tokens = min(self.capacity, self._tokens + (now - start) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            delay = max(self._paused_until - monotonic(), 0.0)
+            await asyncio.sleep(delay + (1 - self._tokens) / self.rate)
+
+    def slow_down(self, pause: float) -> None:
+        self._refill()
+        self._tokens = 0.0
+        self._paused_until = max(self._paused_until, monotonic() + pause)
+        self.rate = max(self.rate / 2, self.nominal_rate / 16)
+
+    def speed_up(self) -> None:
+        if self.rate < self.nominal_rate:
+            self.rate = min(self.nominal_rate, self.rate + self.nominal_rate / 32)
+
+
+@dataclass
+class SendStats:
+    sent: int = 0
+    forbidden: int = 0
+    retried: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.seconds if self.seconds else 0.0
+
+
+class Sender:
+    """Sends messages concurrently within Telegram's global and per-chat limits."""
+
+    def __init__(
+        self,
+        bot: Bot,
+        rate: float,
+        chat_rate: float,
+        concurrency: int,
+        max_retries: int,
+    ) -> None:
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate, rate)
+        # Idle per-chat buckets are full again after 1 / chat_rate seconds,
+        # so they can be dropped after a while.
+        self._chat_buckets: TTLCache[int, TokenBucket] = TTLCache(
+            100_000, max(60.0, 2 / chat_rate)
+        )
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is MISSING:
+            bucket = TokenBucket(self.chat_rate, 1)
+        # Setting on every use keeps the bucket alive while the chat is busy.
+        self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def send(self, chat_id: int, text: str, stats: SendStats) -> bool:
+        chat_bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await chat_bucket.acquire()
+            async with self._semaphore:
+                await self._bucket.acquire()
+                try:
+                    await self.bot.send_message(chat_id, text)
+                except TelegramRetryAfter as e:
+                    stats.retried += 1
+                    logger.warning(
+                        "Flood control while sending to %s, retrying in %ss (attempt %s).",
+                        chat_id,
+                        e.retry_after,
+                        attempt + 1,
+                    )
+                    self._bucket.slow_down(e.retry_after)
+                    chat_bucket.slow_down(e.retry_after)
+                    continue
+                except TelegramForbiddenError:
+                    stats.forbidden += 1
+                    logger.warning(
+                        "Cannot send notification to user %s. They might have blocked the bot or didn't start a chat.",
+                        chat_id,
+                    )
+                    return False
+                except TelegramAPIError as e:
+                    stats.failed += 1
+                    logger.error("Failed to send notification to %s: %s", chat_id, e)
+                    return False
+            self._bucket.speed_up()
+            chat_bucket.speed_up()
+            stats.sent += 1
+            return True
+        stats.failed += 1
+        logger.error("Giving up on notification to %s after flood control.", chat_id)
+        return False
+
+    async def send_all(self, messages: list[tuple[int, str]]) -> SendStats:
+        stats = SendStats()
+        start = monotonic()
+        await asyncio.gather(
+            *(self.send(chat_id, text, stats) for chat_id, text in messages)
+        )
+        stats.seconds = monotonic() - start
+        if messages:
+            logger.info(
+                "Sent %s/%s notifications in %.2fs (%.1f msg/s), %s forbidden, %s retried, %s failed.",
+                stats.sent,
+                len(messages),
+                stats.seconds,
+                stats.rate,
+                stats.forbidden,
+                stats.retried,
+                stats.failed,
+            )
+        return stats
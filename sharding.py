@@ -0,0 +1,262 @@
+import asyncio
+import logging
+from concurrent.futures import Executor
+from time import time
+from typing import Any, Awaitable, Callable
+
+import aiohttp
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+import config
+import database as db
+
+logger = logging.getLogger(__name__)
+
+# Carries the shared secret on updates forwarded between workers.
+FORWARDED_HEADER = "X-Shamebot-Forwarded"
+
+
+def shard_of(chat_id: int) -> int:
+    return abs(chat_id) % config.SHARD_COUNT
+
+
+class ShardLeases:
+    """Leases this worker's share of the chat shards in the database.
+
+    Every worker keeps a Worker row alive. The live workers, ordered by id,
+    split the shards evenly; each one claims free or expired shards up to its
+    share and gives back the ones above it. Claims and renewals are
+    conditional UPDATEs, so a shard never has two owners, and the shards of
+    a worker that dies are taken over once its leases expire.
+
+    `renew` and `release_all` block on the database and belong on the DB
+    executor. While `hold` is set no shard is given back voluntarily, e.g.
+    while a notifier cycle is working on them.
+    """
+
+    def __init__(
+        self, worker_id: str, address: str, shard_count: int, ttl: float
+    ) -> None:
+        self.worker_id = worker_id
+        self.address = address
+        self.shard_count = shard_count
+        self.ttl = ttl
+        self.hold = False
+        self._owned: frozenset[int] = frozenset()
+        self._valid_until = 0.0
+        self._addresses: dict[int, str] = {}
+
+    def current(self) -> frozenset[int]:
+        # Stop using leases a bit before they expire in the database, in
+        # case renewing them keeps failing or clocks are slightly apart.
+        if time() >= self._valid_until:
+            return frozenset()
+        return self._owned
+
+    def owner_address(self, shard: int) -> str:
+        """Address of the other worker owning `shard`, if it has one."""
+        return self._addresses.get(shard, "")
+
+    def renew(self) -> frozenset[int]:
+        now = time()
+        expires_at = now + self.ttl
+        worker = db.Worker.__table__
+        lease = db.ShardLease.__table__
+        with db.Session(db.engine) as session:
+            connection = session.connection()
+            if not db.insert_or_ignore(
+                session,
+                db.Worker,
+                id=self.worker_id,
+                address=self.address,
+                expires_at=expires_at,
+            ):
+                connection.execute(
+                    db.update(worker)
+                    .where(worker.c.id == self.worker_id)
+                    .values(address=self.address, expires_at=expires_at)
+                )
+            connection.execute(
+                db.delete(worker).where(worker.c.expires_at <= now - self.ttl)
+            )
+            known = set(connection.execute(db.select(lease.c.shard)).scalars())
+            for shard in range(self.shard_count):
+                if shard not in known:
+                    db.insert_or_ignore(session, db.ShardLease, shard=shard)
+
+            live = list(
+                connection.execute(
+                    db.select(worker.c.id)
+                    .where(worker.c.expires_at > now)
+                    .order_by(worker.c.id)
+                ).scalars()
+            )
+            index = live.index(self.worker_id)
+            share = self.shard_count // len(live) + (
+                index < self.shard_count % len(live)
+            )
+
+            mine = (
+                lease.c.worker_id == self.worker_id,
+                lease.c.shard < self.shard_count,
+            )
+            connection.execute(
+                db.update(lease)
+                .where(*mine, lease.c.expires_at > now)
+                .values(expires_at=expires_at)
+            )
+            owned = sorted(
+                connection.execute(
+                    db.select(lease.c.shard).where(*mine, lease.c.expires_at > now)
+                ).scalars()
+            )
+            if len(owned) > share and not self.hold:
+                connection.execute(
+                    db.update(lease)
+                    .where(*mine, lease.c.shard.in_(owned[share:]))
+                    .values(worker_id=None, expires_at=0.0)
+                )
+                owned = owned[:share]
+            elif len(owned) < share:
+                free = (
+                    db.or_(lease.c.worker_id == None, lease.c.expires_at <= now),
+                    lease.c.shard < self.shard_count,
+                )
+                candidates = connection.execute(
+                    db.select(lease.c.shard)
+                    .where(*free)
+                    .order_by(lease.c.shard)
+                    .limit(share - len(owned))
+                ).scalars()
+                for shard in list(candidates):
+                    claimed = connection.execute(
+                        db.update(lease)
+                        .where(lease.c.shard == shard, *free)
+                        .values(worker_id=self.worker_id, expires_at=expires_at)
+                    )
+                    if claimed.rowcount:
+                        owned.append(shard)
+
+            addresses = connection.execute(
+                db.select(lease.c.shard, worker.c.address).where(
+                    lease.c.worker_id == worker.c.id,
+                    lease.c.expires_at > now,
+                    worker.c.id != self.worker_id,
+                    worker.c.address != "",
+                )
+            ).all()
+            session.commit()
+
+        if set(owned) != self._owned:
+            logger.info(
+                "Worker %s now owns shards %s of %s (%s live workers)",
+                self.worker_id,
+                sorted(owned),
+                self.shard_count,
+                len(live),
+            )
+        self._owned = frozenset(owned)
+        self._valid_until = expires_at - self.ttl / 4
+        self._addresses = dict(addresses)
+        return self._owned
+
+    def release_all(self) -> None:
+        # Lets the other workers take over right away instead of waiting for
+        # the leases to expire.
+        self._owned = frozenset()
+        self._valid_until = 0.0
+        lease = db.ShardLease.__table__
+        with db.Session(db.engine) as session:
+            connection = session.connection()
+            connection.execute(
+                db.update(lease)
+                .where(lease.c.worker_id == self.worker_id)
+                .values(worker_id=None, expires_at=0.0)
+            )
+            connection.execute(
+                db.delete(db.Worker.__table__).where(
+                    db.Worker.__table__.c.id == self.worker_id
+                )
+            )
+            session.commit()
+
+    async def run(
+        self,
+        interval: float,
+        executor: Executor | None = None,
+        on_change: Callable[[], None] | None = None,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            owned = self._owned
+            try:
+                await loop.run_in_executor(executor, self.renew)
+            except Exception:
+                logger.exception("Failed to renew shard leases.")
+            if on_change is not None and self._owned != owned:
+                on_change()
+
+
+class ShardRouter(BaseMiddleware):
+    """Forwards updates of chats in another worker's shards to that worker.
+
+    Outer middleware for `dp.update`. An update is handled locally when its
+    shard has no reachable owner, so nothing is lost while shards move.
+    Without a secret nothing is forwarded, since receivers refuse it.
+    """
+
+    def __init__(self, leases: ShardLeases, secret: str, timeout: float = 5.0) -> None:
+        self.leases = leases
+        self.secret = secret
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: aiohttp.ClientSession | None = None
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any],
+    ) -> Any:
+        if self.secret and isinstance(event, Update) and not data.get("forwarded"):
+            chat = getattr(event.event, "chat", None)
+            if chat is not None:
+                address = self.leases.owner_address(shard_of(chat.id))
+                if address and await self._forward(address, event):
+                    return None
+        return await handler(event, data)
+
+    async def _forward(self, address: str, update: Update) -> bool:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        try:
+            async with self._session.post(
+                f"{address}/internal/update",
+                data=update.model_dump_json(exclude_unset=True, by_alias=True),
+                headers={
+                    "Content-Type": "application/json",
+                    FORWARDED_HEADER: self.secret,
+                },
+            ) as response:
+                if response.status == 200:
+                    return True
+                logger.warning(
+                    "Worker at %s refused update %s with %s, handling it here",
+                    address,
+                    update.update_id,
+                    response.status,
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(
+                "Failed to forward update %s to %s, handling it here: %r",
+                update.update_id,
+                address,
+                e,
+            )
+        return False
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -0,0 +1,188 @@
+"""Warm-start snapshot of the bot's in-memory caches.
+
+The chat settings, known users and memberships cached by db_handlers are
+written to a compact binary file periodically and on shutdown, and loaded on
+startup, so a restarted bot does not fetch them again one message at a time.
+The snapshot records the version of every chat it covers (see
+db_handlers.sync_chat_versions); on load, entries of chats whose version
+changed since are skipped, and so are users no longer in the database.
+
+Layout: _HEADER, then a zlib-compressed body of little-endian arrays in the
+order save() writes them.
+"""
+
+import logging
+import os
+import struct
+import sys
+import zlib
+from array import array
+from time import time
+
+import config
+import db_handlers as dbh
+
+db = dbh.db
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"SHBS"
+FORMAT_VERSION = 2
+# magic, format version, written at, chats, users, memberships, chat versions
+_HEADER = struct.Struct("<4sHdIIII")
+
+# Membership cache values, stored as their index.
+_STATES = (None, dbh.MEMBER, dbh.ADMIN)
+# Trigger mask and version stored for chats not in the database.
+_NO_CHAT = -1
+
+
+def _pack(typecode: str, values) -> bytes:
+    values = array(typecode, values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+
+class _Reader:
+    def __init__(self, body: bytes) -> None:
+        self._body = memoryview(body)
+        self._offset = 0
+
+    def bytes(self, size: int) -> bytes:
+        data = self._body[self._offset : self._offset + size]
+        if len(data) != size:
+            raise ValueError("truncated snapshot")
+        self._offset += size
+        return bytes(data)
+
+    def array(self, typecode: str, count: int) -> array:
+        values = array(typecode)
+        values.frombytes(self.bytes(values.itemsize * count))
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values
+
+
+def save(path: str) -> int:
+    """Write the caches to `path`; returns the number of entries written."""
+    versions = dbh.sync_chat_versions()
+    chats = dbh.chat_cache.items()
+    users = [user_id for user_id, _ in dbh.user_cache.items()]
+    memberships = dbh.membership_cache.items()
+    covered = sorted(
+        {chat_id for chat_id, _ in chats} | {chat_id for (chat_id, _), _ in memberships}
+    )
+    names = [settings.chat_name.encode() if settings else b"" for _, settings in chats]
+    body = b"".join(
+        [
+            _pack("q", (chat_id for chat_id, _ in chats)),
+            _pack(
+                "i",
+                (
+                    int(settings.triggers) if settings else _NO_CHAT
+                    for _, settings in chats
+                ),
+            ),
+            _pack("I", map(len, names)),
+            *names,
+            _pack("q", users),
+            _pack("q", (chat_id for (chat_id, _), _ in memberships)),
+            _pack("q", (user_id for (_, user_id), _ in memberships)),
+            _pack("b", (_STATES.index(state) for _, state in memberships)),
+            _pack("q", covered),
+            _pack("q", (versions.get(chat_id, _NO_CHAT) for chat_id in covered)),
+        ]
+    )
+    header = _HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        time(),
+        len(chats),
+        len(users),
+        len(memberships),
+        len(covered),
+    )
+    # Write aside and rename, so a crash never leaves half a snapshot. The
+    # name of the file aside is our own, in case another worker shares `path`.
+    temporary = f"{path}.{config.WORKER_ID}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(header)
+        file.write(zlib.compress(body))
+    os.replace(temporary, path)
+    return len(chats) + len(users) + len(memberships)
+
+
+def load(path: str) -> int:
+    """Fill the caches from the entries of the snapshot at `path` that are
+    still valid.
+
+    Returns the number of entries loaded.
+    """
+    versions = dbh.sync_chat_versions()
+    try:
+        with open(path, "rb") as file:
+            header = file.read(_HEADER.size)
+            body = file.read()
+    except FileNotFoundError:
+        return 0
+    try:
+        magic, format_version, written_at, *counts = _HEADER.unpack(header)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            logger.warning("Ignoring snapshot %s of an unknown format.", path)
+            return 0
+        chat_count, user_count, membership_count, covered_count = counts
+        reader = _Reader(zlib.decompress(body))
+        chat_ids = reader.array("q", chat_count)
+        triggers = reader.array("i", chat_count)
+        lengths = reader.array("I", chat_count)
+        chats = [
+            (
+                chat_id,
+                (
+                    None
+                    if mask == _NO_CHAT
+                    else dbh.ChatSettings(name.decode(), db.Trigger(mask))
+                ),
+            )
+            for chat_id, mask, name in zip(
+                chat_ids, triggers, [reader.bytes(length) for length in lengths]
+            )
+        ]
+        users = reader.array("q", user_count)
+        membership_chats = reader.array("q", membership_count)
+        membership_users = reader.array("q", membership_count)
+        states = reader.array("b", membership_count)
+        memberships = [
+            ((chat_id, user_id), _STATES[state])
+            for chat_id, user_id, state in zip(
+                membership_chats, membership_users, states
+            )
+        ]
+        covered = dict(
+            zip(reader.array("q", covered_count), reader.array("q", covered_count))
+        )
+    except (struct.error, zlib.error, ValueError, IndexError) as e:
+        logger.warning("Ignoring unreadable snapshot %s: %s", path, e)
+        return 0
+    current = {
+        chat_id
+        for chat_id, version in covered.items()
+        if versions.get(chat_id, _NO_CHAT) == version
+    }
+    chats = [entry for entry in chats if entry[0] in current]
+    memberships = [entry for entry in memberships if entry[0][0] in current]
+    # Users carry no version, and the snapshot may even come from another
+    # database; only trust the ones still there.
+    users = dbh.get_existing_users(list(users))
+    dbh.chat_cache.set_many(chats)
+    dbh.user_cache.set_many((user_id, True) for user_id in users)
+    dbh.membership_cache.set_many(memberships)
+    logger.info(
+        "Loaded snapshot %s written %.0f seconds ago; %d of its %d chats changed since.",
+        path,
+        time() - written_at,
+        len(covered) - len(current),
+        len(covered),
+    )
+    return len(chats) + len(users) + len(memberships)
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from concurrent.futures import Executor
+from threading import Lock
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# (chat_id, user_id, content_type, trigger_time)
+Activity = tuple[int, int, str, float]
+
+
+class TriggerBuffer:
+    """Write-behind buffer for activity events.
+
+    Triggers are collected in memory and handed to `writer` in one batch when
+    `max_size` of them are pending or when `run()` wakes up every
+    `flush_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        writer: Callable[[list[Activity]], None],
+        max_size: int,
+        flush_interval: float,
+    ) -> None:
+        self._writer = writer
+        self._pending: list[Activity] = []
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(
+        self, chat_id: int, user_id: int, content_type: str, trigger_time: float
+    ) -> None:
+        with self._lock:
+            self._pending.append((chat_id, user_id, content_type, trigger_time))
+            full = len(self._pending) >= self.max_size
+        if full:
+            self.flush()
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if not pending:
+                return 0
+            try:
+                self._writer(pending)
+            except Exception:
+                # Put the batch back so the next flush retries it.
+                with self._lock:
+                    self._pending[:0] = pending
+                raise
+            logger.debug("Flushed %s activity events.", len(pending))
+            return len(pending)
+
+    async def run(self, executor: Executor | None = None) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await loop.run_in_executor(executor, self.flush)
+            except Exception:
+                logger.exception("Failed to flush activity events.")
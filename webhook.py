@@ -0,0 +1,64 @@
+import asyncio
+import logging
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from metrics import QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateQueue:
+    """Feeds webhook updates to the dispatcher from a bounded queue.
+
+    The HTTP handler only enqueues, so Telegram gets its answer right away;
+    `workers` tasks process updates concurrently. When the queue is full
+    `put` returns False and the update should be refused, which makes
+    Telegram deliver it again later.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, max_size: int, workers: int) -> None:
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self._queue: asyncio.Queue[Update] = asyncio.Queue(max_size)
+        self._tasks: list[asyncio.Task] = []
+        QUEUE_DEPTH.labels("webhook").set_function(self._queue.qsize)
+
+    def put(self, update: Update) -> bool:
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logger.warning(
+                "Webhook queue is full, refusing update %s", update.update_id
+            )
+            return False
+        return True
+
+    async def _work(self) -> None:
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception:
+                logger.exception("Failed to process update %s", update.update_id)
+            finally:
+                self._queue.task_done()
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float) -> None:
+        # Updates already acknowledged to Telegram are not redelivered, so
+        # give the workers a chance to finish them.
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except TimeoutError:
+            logger.warning(
+                "Dropping %s queued updates on shutdown", self._queue.qsize()
+            )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()